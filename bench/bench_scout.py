@@ -0,0 +1,120 @@
+import json
+import os
+import sys
+import tempfile
+import tracemalloc
+
+from argparse import ArgumentParser
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import scout_team  # noqa: E402
+
+
+DATASETS = [('small', 1), ('medium', 4), ('full', None)]
+
+
+def configure(args, workers):
+    scout_team.cache = None
+    if args.record:
+        scout_team.client = scout_team.HttpClient(pool_size=workers, record_dir=args.fixtures)
+    else:
+        scout_team.client = scout_team.HttpClient(pool_size=workers, replay_dir=args.fixtures,
+                                                  replay_latency=args.latency)
+
+
+def measure(results, dataset, mode, phase, func):
+    requests_before = scout_team.client.request_count
+    tracemalloc.start()
+    start = perf_counter()
+    result = func()
+    elapsed = perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    results.append({'dataset': dataset, 'mode': mode, 'phase': phase,
+                    'requests': scout_team.client.request_count - requests_before,
+                    'seconds': round(elapsed, 3), 'peak_mb': round(peak / 2 ** 20, 2)})
+    return result
+
+
+def run_dataset(args, results, dataset, teams, players, mode, workers):
+    configure(args, workers)
+    player_names = {}
+    heroes = measure(results, dataset, mode, 'heroes', scout_team.get_heroes)
+
+    def build_teams():
+        indexes = {}
+        built = []
+        for league_id, team_id in teams:
+            if league_id not in indexes:
+                indexes[league_id] = scout_team.LeagueIndex(league_id)
+            built.append(scout_team.Team(team_id, player_names, heroes, indexes[league_id], workers=workers))
+        return built
+
+    built = measure(results, dataset, mode, 'teams', build_teams)
+
+    def resolve_columns():
+        # in the same order as scout_batch, so name lookups are batched the way they were recorded
+        for team in built:
+            team.resolve_columns(scout_team.DEFAULT_COLUMNS)
+
+    measure(results, dataset, mode, 'columns', resolve_columns)
+    account_ids = set(players)
+    for team in built:
+        account_ids.update(team.players)
+    profiles = measure(results, dataset, mode, 'players',
+                       lambda: scout_team.get_players(account_ids, player_names, heroes, workers=workers))
+
+    def write():
+        with tempfile.TemporaryDirectory() as directory:
+            writer = scout_team.XlsxWriter(os.path.join(directory, 'bench.xlsx'), constant_memory=args.constant_memory)
+            for team in built:
+                writer.write_matches(team)
+                writer.write_summary(team)
+            writer.write_legend()
+            writer.write_players(profiles, [])
+            writer.close()
+
+    measure(results, dataset, mode, 'xlsx', write)
+
+
+def print_results(results):
+    print('{:<8} {:<11} {:<8} {:>9} {:>9} {:>9}'.format('DATASET', 'MODE', 'PHASE', 'REQUESTS', 'SECONDS', 'PEAK MB'))
+    for row in results:
+        print('{dataset:<8} {mode:<11} {phase:<8} {requests:>9} {seconds:>9.3f} {peak_mb:>9.2f}'.format(**row))
+
+
+def get_args():
+    parser = ArgumentParser(description='time scout_team against recorded api fixtures -- record them first with '
+                                        '--record so every dataset looks up names in the same batches it replays')
+    parser.add_argument('fixtures', help='fixture directory recorded with --record')
+    parser.add_argument('--record', metavar='API_KEY', help='run each dataset once against the live apis with this '
+                                                             'key and save the responses to the fixture directory')
+    parser.add_argument('manifest', help='manifest of the teams and players that were recorded -- the same format as scout_team.py --manifest')
+    parser.add_argument('--latency', type=float, default=.05, help='seconds of synthetic latency per replayed request')
+    parser.add_argument('-w', '--workers', type=int, default=scout_team.WORKERS, help='workers for the concurrent mode')
+    parser.add_argument('--constant-memory', action='store_true', help='write the workbook in constant memory mode')
+    parser.add_argument('--json', help='also write the results to this file as json')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    api_key = args.record or 'replay'
+    scout_team.DOTA_BASE_URL = scout_team.DOTA_BASE_URL.format(api_key=api_key)
+    scout_team.STEAM_USER_BASE_URL = scout_team.STEAM_USER_BASE_URL.format(api_key=api_key)
+    teams, players = scout_team.read_manifest(args.manifest)
+    # the smaller datasets batch different players into each name lookup, so each is recorded on its own
+    modes = [('record', args.workers)] if args.record else [('serial', 1), ('concurrent', args.workers)]
+
+    results = []
+    for dataset, size in DATASETS:
+        for mode, workers in modes:
+            run_dataset(args, results, dataset, teams[:size], players, mode, workers)
+
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
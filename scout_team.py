@@ -1,73 +1,697 @@
-import requests
-import xlsxwriter
+import cProfile
+import copy
+import csv
+import hashlib
+import json
+import math
+import os
+import random
+import sqlite3
+import threading
+import time
+import zlib
 
 from argparse import ArgumentParser
-from collections import defaultdict
-from datetime import datetime
+from array import array
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from difflib import get_close_matches
+from io import BytesIO
 from itertools import zip_longest
-from time import sleep
-from urllib.parse import urlencode
+from time import perf_counter, sleep
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
 
 
 DOTA_BASE_URL = 'https://api.steampowered.com/IDOTA2Match_570/{{func_name}}/V1/?key={api_key}&{{params}}'
+STEAM_USER_BASE_URL = 'https://api.steampowered.com/ISteamUser/{{func_name}}/v2/?key={api_key}&{{params}}'
 OPENDOTA_BASE_URL = 'https://api.opendota.com/api/{func_name}/{params}'
 LANE = {1: 'S', 2: 'M', 3: 'O', 4: 'J'}
+SHEET_NAME_LENGTH = 31
+INVALID_SHEET_NAME_CHARACTERS = '[]:*?/\\'
 COLORS = ['white', 'yellow', 'orange', 'cyan', 'silver', '#FF7F50', '#FFD700', '#ADFF2F',
           '#40E0D0', '#00BFFF', '#D8BFD8', '#FFC0CB', '#FAEBD7', '#E6E6FA', '#FFD700']
+CACHE_FILE = os.path.join(os.path.expanduser('~'), '.cache', 'scout_team', 'cache.sqlite3')
+STATE_VERSION = 5
+STATE_FILE = os.path.join(os.path.expanduser('~'), '.cache', 'scout_team', 'state.sqlite3')
+HEROES_FILE = os.path.join(os.path.expanduser('~'), '.cache', 'scout_team', 'heroes.json')
+CACHE_TTL = 6 * 60 * 60
+NAME_TTL = 24 * 60 * 60
+# a hero table older than this is still used, but refreshed in the background for the next run
+HEROES_TTL = 24 * 60 * 60
+# how close a counterpick name has to be to a hero's name to be taken as a typo of it
+HERO_MATCH_CUTOFF = .75
+WORKERS = 8
+TEAM_WORKERS = 4
+# optional report columns that cost extra requests -- captain names, player names on picks and roster profiles
+COLUMNS = ['captain', 'players', 'profiles']
+DEFAULT_COLUMNS = ['captain', 'profiles']
+ANALYTICS_MIN_GAMES = 2
+# opendota parse requests -- how often a match is resubmitted before giving up, and seconds between polls
+PARSE_ATTEMPTS = 3
+PARSE_BACKOFF = 5
+PARSE_MAX_BACKOFF = 120
+SERVE_HOST = '127.0.0.1'
+SERVE_PORT = 8080
+SERVE_INTERVAL = 5 * 60
+# rows a table writer buffers per table before flushing them to disk
+TABLE_BATCH = 10000
+FORMATS = ['xlsx', 'csv', 'jsonl', 'parquet']
+# columns of every table the csv, jsonl and parquet writers export
+TABLES = {
+    'matches': [('league_id', 'int'), ('team_id', 'int'), ('team', 'str'), ('match_id', 'int'), ('parsed', 'bool'),
+                ('side', 'str'), ('win', 'bool'), ('first_pick', 'bool'), ('enemy_captain_id', 'int'),
+                ('enemy_captain', 'str'), ('parse_status', 'str')],
+    'picks_bans': [('league_id', 'int'), ('team_id', 'int'), ('match_id', 'int'), ('kind', 'str'), ('order', 'int'),
+                   ('hero_id', 'int'), ('hero', 'str'), ('lane', 'str'), ('roaming', 'bool'), ('account_id', 'int'),
+                   ('player', 'str')],
+    'team_heroes': [('league_id', 'int'), ('team_id', 'int'), ('team', 'str'), ('hero_id', 'int'), ('hero', 'str'),
+                    ('picks', 'int'), ('wins', 'int'), ('bans', 'int'), ('banned_against', 'int')],
+    'drafts': [('league_id', 'int'), ('team_id', 'int'), ('banned_hero', 'str'), ('times', 'int'),
+               ('pick_hero', 'str'), ('count', 'int')],
+    'player_heroes': [('account_id', 'int'), ('player', 'str'), ('hero', 'str'), ('games', 'int'), ('wins', 'int'),
+                      ('highlight', 'bool')],
+    'player_recent_heroes': [('account_id', 'int'), ('player', 'str'), ('hero', 'str'), ('games', 'int'),
+                             ('wins', 'int'), ('highlight', 'bool')],
+    'hero_meta': [('league_id', 'int'), ('matches', 'int'), ('hero', 'str'), ('picks', 'int'), ('bans', 'int'),
+                  ('wins', 'int'), ('first_phase_bans', 'int'), ('later_bans', 'int')],
+    'synergy': [('league_id', 'int'), ('hero', 'str'), ('with_hero', 'str'), ('games', 'int'), ('wins', 'int')],
+    'counters': [('league_id', 'int'), ('hero', 'str'), ('against_hero', 'str'), ('games', 'int'), ('wins', 'int')],
+}
+# requests per second -- opendota's free tier allows 60 a minute and steam asks for about one a second
+RATE_LIMITS = {'api.steampowered.com': 1, 'api.opendota.com': 1}
+RETRIES = 5
+BACKOFF = 1
+MAX_BACKOFF = 60
+TIMEOUT = 30
+# 64-bit steam ids are the 32-bit dota account id plus this offset
+STEAM_ID_OFFSET = 76561197960265728
+PLAYER_SUMMARIES_BATCH = 100
+# upper bounds in seconds for the request latency histogram, anything slower goes in a final bucket
+LATENCY_BUCKETS = [.05, .1, .25, .5, 1, 2.5, 5, 10]
+# finished matches never change, so these responses are cached forever
+IMMUTABLE_ENDPOINTS = {'GetMatchDetails', 'matches'}
+
+cache = None
+name_ttl = NAME_TTL
+
+
+class TokenBucket(object):
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            sleep(wait)
+
+
+class Stats(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.phases = defaultdict(float)
+        self.busy = defaultdict(float)
+        self.active = defaultdict(int)
+        self.active_since = {}
+        self.requests = defaultdict(int)
+        self.latencies = defaultdict(lambda: [0] * (len(LATENCY_BUCKETS) + 1))
+        self.request_seconds = defaultdict(float)
+        self.bytes = defaultdict(int)
+        self.cache_hits = defaultdict(int)
+        self.cache_misses = defaultdict(int)
+
+    # phases can run on several threads at once -- the wall clock only counts while at least one thread is
+    # in the phase, busy is the time summed over every thread
+    @contextmanager
+    def phase(self, name):
+        with self.lock:
+            start = perf_counter()
+            if not self.active[name]:
+                self.active_since[name] = start
+            self.active[name] += 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                end = perf_counter()
+                self.busy[name] += end - start
+                self.active[name] -= 1
+                if not self.active[name]:
+                    self.phases[name] += end - self.active_since.pop(name)
+
+    def record_request(self, endpoint, seconds, size):
+        bucket = next((i for i, bound in enumerate(LATENCY_BUCKETS) if seconds <= bound), len(LATENCY_BUCKETS))
+        with self.lock:
+            self.requests[endpoint] += 1
+            self.request_seconds[endpoint] += seconds
+            self.latencies[endpoint][bucket] += 1
+            self.bytes[endpoint] += size
+
+    def record_cache(self, endpoint, hit):
+        with self.lock:
+            if hit:
+                self.cache_hits[endpoint] += 1
+            else:
+                self.cache_misses[endpoint] += 1
+
+    def to_dict(self):
+        labels = ['<={}s'.format(bound) for bound in LATENCY_BUCKETS] + ['>{}s'.format(LATENCY_BUCKETS[-1])]
+        endpoints = sorted(set(self.requests) | set(self.cache_hits) | set(self.cache_misses))
+        return {
+            'phases': {name: round(seconds, 3) for name, seconds in self.phases.items()},
+            'busy': {name: round(seconds, 3) for name, seconds in self.busy.items()},
+            'endpoints': {endpoint: {'requests': self.requests[endpoint],
+                                     'seconds': round(self.request_seconds[endpoint], 3),
+                                     'bytes': self.bytes[endpoint],
+                                     'cache_hits': self.cache_hits[endpoint],
+                                     'cache_misses': self.cache_misses[endpoint],
+                                     'latency': dict(zip(labels, self.latencies[endpoint]))}
+                          for endpoint in endpoints},
+            'requests': sum(self.requests.values()),
+            'bytes': sum(self.bytes.values()),
+        }
+
+    def print(self):
+        data = self.to_dict()
+        print('PHASE                 SECONDS      BUSY')
+        for name, seconds in data['phases'].items():
+            print('{:<20} {:>8.3f} {:>9.3f}'.format(name, seconds, data['busy'][name]))
+        print()
+        print('ENDPOINT              REQUESTS  SECONDS      BYTES  CACHE HITS  CACHE MISSES')
+        for endpoint, endpoint_data in data['endpoints'].items():
+            print('{:<20} {requests:>9} {seconds:>8.3f} {bytes:>10} {cache_hits:>11} {cache_misses:>13}'.format(
+                endpoint, **endpoint_data))
+        print()
+        print('{} requests, {} bytes downloaded'.format(data['requests'], data['bytes']))
+
+
+class FixtureResponse(object):
+    def __init__(self, status_code, reason, text):
+        self.status_code = status_code
+        self.reason = reason
+        self.text = text
+        self.content = text.encode()
+        self.ok = status_code < 400
+        self.headers = {}
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class HttpClient(object):
+    def __init__(self, rate_limits=RATE_LIMITS, retries=RETRIES, pool_size=WORKERS,
+                 record_dir=None, replay_dir=None, replay_latency=0):
+        self.rate_limits = rate_limits
+        self.retries = retries
+        self.pool_size = pool_size
+        self.record_dir = record_dir
+        self.replay_dir = replay_dir
+        self.replay_latency = replay_latency
+        self.sessions = {}
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.request_count = 0
+
+        if record_dir:
+            os.makedirs(record_dir, exist_ok=True)
 
+    def close(self):
+        for session in self.sessions.values():
+            session.close()
+
+    def get_session(self, host):
+        # requests takes a while to import, so runs that never touch the network don't pay for it
+        import requests
+
+        with self.lock:
+            if host not in self.sessions:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.pool_size)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self.sessions[host] = session
+                self.buckets[host] = TokenBucket(self.rate_limits.get(host, 1))
+            return self.sessions[host], self.buckets[host]
+
+    def get_fixture_file(self, directory, url, method='GET'):
+        # fixtures are named after the url without the api key so they can be shared
+        parts = urlsplit(url)
+        query = urlencode([(k, v) for k, v in parse_qsl(parts.query) if k != 'key'])
+        name = urlunsplit(parts._replace(query=query))
+        if method != 'GET':
+            name = '{} {}'.format(method, name)
+        return os.path.join(directory, hashlib.sha1(name.encode()).hexdigest() + '.json')
+
+    def record(self, method, url, resp):
+        with open(self.get_fixture_file(self.record_dir, url, method), 'w') as f:
+            json.dump({'status_code': resp.status_code, 'reason': resp.reason, 'text': resp.text}, f)
+
+    def replay(self, method, url):
+        if self.replay_latency:
+            sleep(self.replay_latency)
+        try:
+            with open(self.get_fixture_file(self.replay_dir, url, method)) as f:
+                fixture = json.load(f)
+        except FileNotFoundError:
+            return FixtureResponse(404, 'No fixture recorded', '{}')
+        return FixtureResponse(fixture['status_code'], fixture['reason'], fixture['text'])
+
+    def get(self, url):
+        return self.send('GET', url)
+
+    def post(self, url):
+        return self.send('POST', url)
+
+    def send(self, method, url):
+        with self.lock:
+            self.request_count += 1
+        if self.replay_dir:
+            return self.replay(method, url)
+
+        resp = self.request(method, url)
+        if self.record_dir and resp.ok:
+            self.record(method, url, resp)
+        return resp
+
+    def request(self, method, url):
+        import requests
+
+        session, bucket = self.get_session(urlsplit(url).netloc)
+        for attempt in range(self.retries + 1):
+            bucket.acquire()
+            try:
+                resp = session.request(method, url, timeout=TIMEOUT)
+            except requests.RequestException:
+                if attempt == self.retries:
+                    raise
+                sleep(self.get_backoff(attempt))
+                continue
 
-def dota_api_call(func_name, **params):
-    resp = requests.get(DOTA_BASE_URL.format(func_name=func_name, params=urlencode(params)))
+            if resp.status_code != 429 and resp.status_code < 500:
+                return resp
+            if attempt == self.retries:
+                return resp
+            sleep(self.get_retry_after(resp) or self.get_backoff(attempt))
+        return resp
+
+    def get_backoff(self, attempt):
+        # full jitter so concurrent workers don't retry in lockstep
+        return random.uniform(0, min(MAX_BACKOFF, BACKOFF * 2 ** attempt))
+
+    def get_retry_after(self, resp):
+        from email.utils import parsedate_to_datetime
+
+        retry_after = resp.headers.get('Retry-After')
+        if not retry_after:
+            return None
+        try:
+            return max(0, float(retry_after))
+        except ValueError:
+            pass
+        try:
+            return max(0, (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds())
+        except (TypeError, ValueError):
+            return None
+
+
+client = HttpClient()
+stats = Stats()
+
+
+class ResponseCache(object):
+    def __init__(self, file, ttl=CACHE_TTL, refresh=False):
+        directory = os.path.dirname(file)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self.ttl = ttl
+        self.refresh = refresh
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(file, check_same_thread=False)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS responses '
+                                '(key TEXT PRIMARY KEY, data BLOB NOT NULL, expires REAL)')
+        self.connection.commit()
 
-    if not resp.ok:
-        raise Exception('Something went wrong: GET {}: {} {}'.format(func_name, resp.status_code, resp.reason))
-    return resp.json().get('result', {})
+    def close(self):
+        self.connection.close()
+
+    def get(self, key):
+        if self.refresh:
+            return None
+
+        with self.lock:
+            row = self.connection.execute('SELECT data, expires FROM responses WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+
+        data, expires = row
+        if expires is not None and expires < time.time():
+            return None
+        return json.loads(zlib.decompress(data))
+
+    def set(self, key, value, immutable=False, ttl=None):
+        data = zlib.compress(json.dumps(value).encode())
+        expires = None if immutable else time.time() + (ttl or self.ttl)
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO responses (key, data, expires) VALUES (?, ?, ?)',
+                                    (key, data, expires))
+            self.connection.commit()
+
+    def prune(self):
+        with self.lock:
+            cursor = self.connection.execute('DELETE FROM responses WHERE expires IS NOT NULL AND expires < ?',
+                                             (time.time(),))
+            self.connection.commit()
+            self.connection.execute('VACUUM')
+        return cursor.rowcount
+
+
+class StateStore(object):
+    def __init__(self, file):
+        directory = os.path.dirname(file)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
 
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(file, check_same_thread=False)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, data TEXT NOT NULL)')
+        self.connection.commit()
 
-def opendota_api_call(func_name, *params):
-    resp = requests.get(OPENDOTA_BASE_URL.format(func_name=func_name, params='/'.join(params)))
+    def close(self):
+        self.connection.close()
 
-    if not resp.ok:
-        raise Exception('Something went wrong: GET {}: {} {}'.format(func_name, resp.status_code, resp.reason))
+    def get(self, key, default=None):
+        with self.lock:
+            row = self.connection.execute('SELECT data FROM state WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return default
+        return json.loads(row[0])
+
+    def set(self, key, value):
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO state (key, data) VALUES (?, ?)', (key, json.dumps(value)))
+            self.connection.commit()
+
+
+def cache_get(key, endpoint):
+    if cache is None:
+        return None
+    data = cache.get(key)
+    stats.record_cache(endpoint, data is not None)
+    return data
+
+
+def cache_set(key, value, func_name, ttl=None):
+    if cache is None:
+        return
+    immutable = func_name in IMMUTABLE_ENDPOINTS
+    # an unparsed match gains its draft once opendota parses the replay, so it expires like everything else
+    if func_name == 'matches' and not value.get('picks_bans'):
+        immutable = False
+    cache.set(key, value, immutable=immutable, ttl=ttl)
 
+
+def api_get(endpoint, url):
+    return api_request('GET', endpoint, url)
+
+
+def api_post(endpoint, url):
+    return api_request('POST', endpoint, url)
+
+
+def api_request(method, endpoint, url):
+    start = perf_counter()
+    resp = client.send(method, url)
+    stats.record_request(endpoint, perf_counter() - start, len(resp.content))
+
+    if not resp.ok:
+        raise Exception('Something went wrong: {} {}: {} {}'.format(method, endpoint, resp.status_code, resp.reason))
     return resp.json()
 
 
+def dota_api_call(func_name, refresh=False, **params):
+    key = 'dota/{}?{}'.format(func_name, urlencode(sorted(params.items())))
+    data = None if refresh else cache_get(key, func_name)
+    if data is not None:
+        return data
+
+    data = api_get(func_name, DOTA_BASE_URL.format(func_name=func_name, params=urlencode(params))).get('result', {})
+    cache_set(key, data, func_name)
+    return data
+
+
+def opendota_api_call(func_name, *params, refresh=False, **query):
+    url = OPENDOTA_BASE_URL.format(func_name=func_name, params='/'.join(params))
+    key = 'opendota/{}/{}'.format(func_name, '/'.join(params))
+    if query:
+        url += '?' + urlencode(query)
+        key += '?' + urlencode(sorted(query.items()))
+
+    # ids are left out of the endpoint name so e.g. every players/{id}/heroes call is counted together
+    endpoint = '/'.join([func_name] + [p for p in params if not p.isdigit()])
+    data = None if refresh else cache_get(key, endpoint)
+    if data is not None:
+        return data
+
+    data = api_get(endpoint, url)
+    cache_set(key, data, func_name)
+    return data
+
+
+def opendota_parse_request(match_id):
+    # opendota queues the replay for parsing and returns a job that can be polled until it is done
+    data = api_post('request/submit', OPENDOTA_BASE_URL.format(func_name='request', params=match_id))
+    return data['job']['jobId']
+
+
+def opendota_parse_done(job_id):
+    # finished jobs are removed from the queue, so a job that can't be found any more is done
+    return not api_get('request', OPENDOTA_BASE_URL.format(func_name='request', params=job_id))
+
+
+def steam_user_api_call(func_name, **params):
+    return api_get(func_name, STEAM_USER_BASE_URL.format(func_name=func_name, params=urlencode(params))).get('response', {})
+
+
 def get_heroes():
     data = opendota_api_call('heroes')
     return {hero['id']: hero['localized_name'] for hero in data}
 
 
-def get_enemy_captain(match_id, side, player_names):
-    data = dota_api_call('GetMatchDetails', match_id=match_id)
-    captain_id = data.get('dire_captain') if side == 'radiant' else data.get('radiant_captain')
-    if captain_id:
-        return get_player_name(captain_id, player_names)
-    return ''
+def get_hero_data(refresh=False):
+    return [{'id': hero['id'], 'name': hero['name'], 'localized_name': hero['localized_name']}
+            for hero in opendota_api_call('heroes', refresh=refresh)]
 
 
-def get_player_names(match, picks, player_names):
-    for player in match['players']:
-        hero_id = player['hero_id']
-        account_id = player['account_id']
-        if hero_id not in picks:
-            continue
-        picks[hero_id]['player_name'] = get_player_name(account_id, player_names)
+class HeroIndex(object):
+    def __init__(self, file=None, ttl=HEROES_TTL, refresh=False):
+        self.file = file
+        self.thread = None
+        self.lock = threading.Lock()
+        self.updated = False
+        self.heroes = {}
+        self.ids = {}
 
-    return picks, player_names
+        # the saved table is used straight away, so the network is only on the critical path the first time
+        data = self.read() if file and not refresh else None
+        if data is None:
+            data = get_hero_data()
+            self.write(data)
+        elif time.time() - os.path.getmtime(file) > ttl:
+            self.thread = threading.Thread(target=self.refresh)
+            self.thread.start()
+        self.load(data)
+
+    def close(self):
+        if self.thread:
+            self.thread.join()
+
+    def read(self):
+        try:
+            with open(self.file) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def write(self, data):
+        if not self.file:
+            return
+        directory = os.path.dirname(self.file)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # written to a temporary file first so a concurrent run never reads half a table
+        temporary = '{}.{}.{}.tmp'.format(self.file, os.getpid(), threading.get_ident())
+        with open(temporary, 'w') as f:
+            json.dump(data, f)
+        os.replace(temporary, self.file)
+
+    def refresh(self):
+        try:
+            self.write(get_hero_data(refresh=True))
+        except Exception as e:
+            print('Could not refresh the hero table: {}'.format(e))
+
+    @staticmethod
+    def normalize(name):
+        return ''.join(c for c in name.lower() if c.isalnum())
+
+    def update(self, hero_ids):
+        # a saved table can be missing a hero released since, which is fetched straight away rather than
+        # on the next background refresh -- only once a run, in case the id is one opendota doesn't list
+        if self.updated or all(hero_id in self.heroes for hero_id in hero_ids):
+            return
+        with self.lock:
+            if self.updated:
+                return
+            self.updated = True
+            data = get_hero_data(refresh=True)
+            self.write(data)
+            self.load(data)
+
+    def load(self, data):
+        # the table is updated in place, teams and players all hold on to the same one
+        self.heroes.update((hero['id'], hero['localized_name']) for hero in data)
+        # heroes can be found by their name or their internal one, e.g. shadow fiend or nevermore
+        ids = {}
+        for hero in data:
+            ids.setdefault(self.normalize(hero['name'].replace('npc_dota_hero_', '')), hero['id'])
+        for hero in data:
+            ids[self.normalize(hero['localized_name'])] = hero['id']
+        self.ids = ids
+
+    def find(self, name):
+        # returns the hero id and whether the name had to be guessed, or None if nothing is close
+        key = self.normalize(name)
+        if key in self.ids:
+            return self.ids[key], False
+        matches = get_close_matches(key, self.ids, n=1, cutoff=HERO_MATCH_CUTOFF)
+        if not matches:
+            return None, False
+        return self.ids[matches[0]], True
+
+
+hero_index = None
+
+
+def update_heroes(hero_ids):
+    if hero_index:
+        hero_index.update(hero_ids)
+
+
+def get_match_fields(data):
+    # full opendota payloads can be hundreds of kb, so only the fields the matches use are kept
+    update_heroes([player['hero_id'] for player in data['players']] +
+                  [pick_ban['hero_id'] for pick_ban in data.get('picks_bans') or []])
+    return {'match_id': data['match_id'],
+            'dire_team_id': data['dire_team_id'],
+            'radiant_win': data['radiant_win'],
+            'radiant_captain': data.get('radiant_captain'),
+            'dire_captain': data.get('dire_captain'),
+            'picks_bans': data.get('picks_bans'),
+            'players': [{'hero_id': player['hero_id'],
+                         'account_id': player['account_id'],
+                         'lane_role': player.get('lane_role'),
+                         'is_roaming': player.get('is_roaming')} for player in data['players']]}
+
+
+def get_enemy_captain_id(data, side):
+    return data.get('dire_captain') if side == 'radiant' else data.get('radiant_captain')
 
 
 def get_player_name(account_id, player_names):
     account_id = str(account_id)
     if account_id not in player_names:
-        data = opendota_api_call('players', account_id)
-        player_names[account_id] = data['profile']['personaname']
+        name = cache_get('name/' + account_id, 'names')
+        if name is None:
+            data = opendota_api_call('players', account_id)
+            name = data['profile']['personaname']
+            cache_set('name/' + account_id, name, 'name', ttl=name_ttl)
+        player_names[account_id] = name
     return player_names[account_id]
 
 
+def resolve_player_names(account_ids, player_names):
+    with stats.phase('names'):
+        return _resolve_player_names(account_ids, player_names)
+
+
+def _resolve_player_names(account_ids, player_names):
+    missing = []
+    for account_id in sorted({str(a) for a in account_ids if a}):
+        if account_id in player_names:
+            continue
+        name = cache_get('name/' + account_id, 'names')
+        if name is None:
+            missing.append(account_id)
+        else:
+            player_names[account_id] = name
+
+    for start in range(0, len(missing), PLAYER_SUMMARIES_BATCH):
+        steam_ids = [str(int(a) + STEAM_ID_OFFSET) for a in missing[start:start + PLAYER_SUMMARIES_BATCH]]
+        data = steam_user_api_call('GetPlayerSummaries', steamids=','.join(steam_ids))
+        for player in data.get('players', []):
+            account_id = str(int(player['steamid']) - STEAM_ID_OFFSET)
+            player_names[account_id] = player['personaname']
+            cache_set('name/' + account_id, player['personaname'], 'name', ttl=name_ttl)
+
+    # anyone steam didn't return is looked up one at a time by get_player_name
+    return player_names
+
+
+class Pick(object):
+    __slots__ = ('hero_id', 'order', 'lane', 'roaming', 'player_name', 'account_id')
+
+    def __init__(self, hero_id, order=None, lane=None, roaming=False, player_name=None, account_id=None):
+        self.hero_id = hero_id
+        self.order = order
+        self.lane = lane
+        self.roaming = roaming
+        self.player_name = player_name
+        self.account_id = account_id
+
+    def to_list(self):
+        return [self.hero_id, self.order, self.lane, self.roaming, self.player_name, self.account_id]
+
+
+class HeroCounter(object):
+    __slots__ = ('counts',)
+
+    # one slot per hero id, so counting is an index instead of a dict lookup
+    def __init__(self, size):
+        self.counts = array('I', [0]) * size
+
+    def __getitem__(self, hero_id):
+        return self.counts[hero_id] if hero_id < len(self.counts) else 0
+
+    def add(self, hero_id, value=1):
+        if hero_id >= len(self.counts):
+            # a hero newer than the table the counter was sized from
+            self.counts.extend(array('I', [0]) * (hero_id + 1 - len(self.counts)))
+        self.counts[hero_id] += value
+
+    def items(self):
+        return [(hero_id, count) for hero_id, count in enumerate(self.counts) if count]
+
+
 class Match(object):
+    __slots__ = ('team_id', 'match_id', 'side', 'win', 'picks')
+    summary_fields = ['match_id', 'team_id', 'side', 'win', 'picks']
+    # picks are stored as lists since json only has string keys
+    pick_fields = {'picks', 'bans', 'banned_against'}
+
     def __init__(self, data, team_id, players):
-        self.data = data
         self.team_id = team_id
         self.match_id = data['match_id']
         self.side = self.get_side(team_id, str(data['dire_team_id']))
@@ -86,84 +710,137 @@ class Match(object):
             return True
         return False
 
+    def get_summary(self):
+        summary = {}
+        for field in self.summary_fields:
+            value = getattr(self, field)
+            summary[field] = [p.to_list() for p in value.values()] if field in self.pick_fields else value
+        return summary
+
+    @classmethod
+    def from_summary(cls, summary):
+        match = cls.__new__(cls)
+        for field in cls.summary_fields:
+            value = summary[field]
+            if field in cls.pick_fields:
+                value = {p[0]: Pick(*p) for p in value}
+            setattr(match, field, value)
+        return match
+
 
 class ParsedMatch(Match):
-    def __init__(self, data, team_id, players, heroes):
+    __slots__ = ('first_pick', 'bans', 'banned_against', 'enemy_captain_id', 'enemy_captain')
+    summary_fields = Match.summary_fields + ['first_pick', 'bans', 'banned_against', 'enemy_captain_id',
+                                             'enemy_captain']
+
+    def __init__(self, data, team_id, players):
         Match.__init__(self, data, team_id, players)
-        self.team_side_number = 0 if self.side == 'radiant' else 1
         self.first_pick = None
         self.bans = {}
         self.banned_against = {}
-        self.enemy_captain = get_enemy_captain(self.match_id, self.side, players)
-        self.get_picks_bans(heroes)
-        self.get_player_info()
+        # the captain's name is only looked up if the report has a captain column, see Team.fetch_captains
+        self.enemy_captain_id = get_enemy_captain_id(data, self.side)
+        self.enemy_captain = None
+        self.get_picks_bans(data)
+        self.get_player_info(data)
+
+    # derived from side so matches loaded from saved state have it too
+    @property
+    def team_side_number(self):
+        return 0 if self.side == 'radiant' else 1
+
+    def get_picks_bans(self, data):
+        for picks_bans in sorted(data['picks_bans'], key=lambda pb: pb['order']):
+            # whoever makes the first pick of the draft has first pick
+            if self.first_pick is None and picks_bans['is_pick']:
+                self.first_pick = picks_bans['team'] == self.team_side_number
 
-    def get_picks_bans(self, heroes):
-        for picks_bans in self.data['picks_bans']:
             # enemy pick, don't care
             if picks_bans['team'] != self.team_side_number and picks_bans['is_pick']:
                 continue
 
-            if self.first_pick is None:
-                if picks_bans['team'] == self.team_side_number and picks_bans['is_pick']:
-                    self.first_pick = picks_bans['order'] == 6
-
             hero_id = picks_bans['hero_id']
-            hero_name = heroes[hero_id]
+            pick = Pick(hero_id, order=picks_bans['order'])
             if picks_bans['is_pick']:
-                self.picks[hero_id] = {'name': hero_name, 'order': picks_bans['order']}
+                self.picks[hero_id] = pick
             else:
                 if picks_bans['team'] == self.team_side_number:
-                    self.bans[hero_id] = {'name': hero_name, 'order': picks_bans['order']}
+                    self.bans[hero_id] = pick
                 else:
-                    self.banned_against[hero_id] = {'name': hero_name, 'order': picks_bans['order']}
+                    self.banned_against[hero_id] = pick
 
-    def get_player_info(self):
-        for player in self.data['players']:
+    def get_player_info(self, data):
+        for player in data['players']:
             hero_id = player['hero_id']
             if hero_id not in self.picks:
                 continue
-            self.picks[hero_id].update({'lane': LANE[player['lane_role']],
-                                        'roaming': player['is_roaming']})
+            self.picks[hero_id].lane = LANE[player['lane_role']]
+            self.picks[hero_id].roaming = player['is_roaming']
+            self.picks[hero_id].account_id = player['account_id']
 
 
 class UnparsedMatch(Match):
-    def __init__(self, data, team_id, players, heroes, account_ids):
+    __slots__ = ()
+
+    def __init__(self, data, team_id, players, account_ids):
         Match.__init__(self, data, team_id, players)
-        self.get_player_info(heroes, account_ids)
+        self.get_player_info(data, account_ids)
 
-    def get_player_info(self, heroes, account_ids):
-        for player in self.data['players']:
+    def get_player_info(self, data, account_ids):
+        for player in data['players']:
             hero_id = player['hero_id']
             if str(player['account_id']) not in account_ids:
                 continue
-            self.picks[hero_id] = ({'name': heroes[hero_id],
-                                    'lane': LANE[player['lane_role']],
-                                    'roaming': player['is_roaming']})
+            self.picks[hero_id] = Pick(hero_id, lane=LANE[player['lane_role']], roaming=player['is_roaming'],
+                                       account_id=player['account_id'])
+
+
+def get_player_hero_stats(account_id, days=None, window=None):
+    query = window.get_query(days) if window else {'date': days} if days else {}
+    return opendota_api_call('players', account_id, 'heroes', **query)
+
+
+def get_player_recent_matches(account_id, window=None):
+    if not window:
+        return opendota_api_call('players', account_id, 'recentMatches')
+
+    # recentMatches is always the last 20 games, so a window asks for the player's matches in it instead
+    data = opendota_api_call('players', account_id, 'matches', **window.get_query())
+    return [match for match in data if window.contains(match.get('start_time'))]
+
+
+def get_players(account_ids, player_names, heroes, workers=WORKERS, days=None, window=None):
+    # every profile request for every player goes into one pool, then players are built in id order
+    account_ids = sorted(account_ids)
+    resolve_player_names(account_ids, player_names)
+    with stats.phase('players'), ThreadPoolExecutor(max_workers=workers) as executor:
+        hero_stats = [executor.submit(get_player_hero_stats, a, days, window) for a in account_ids]
+        recent_matches = [executor.submit(get_player_recent_matches, a, window) for a in account_ids]
+        return [Player(account_id, player_names, heroes, hero_stats=h.result(), recent_matches=r.result())
+                for account_id, h, r in zip(account_ids, hero_stats, recent_matches)]
 
 
 class Player(object):
-    def __init__(self, account_id, player_names, heroes):
+    def __init__(self, account_id, player_names, heroes, hero_stats, recent_matches):
         self.account_id = account_id
         self.name = get_player_name(self.account_id, player_names)
-        self.heroes = self.get_heroes(heroes)
-        self.recent_heroes = self.get_recent_heroes(heroes)
-
-    def get_heroes(self, heroes):
-        data = opendota_api_call('players', self.account_id, 'heroes')
+        self.heroes = self.get_heroes(heroes, hero_stats)
+        self.recent_heroes = self.get_recent_heroes(heroes, recent_matches)
 
+    def get_heroes(self, heroes, data):
         hero_data = []
-        for hero in sorted(data, key=lambda h: h['games'], reverse=True)[:5]:
+        top = sorted(data, key=lambda h: h['games'], reverse=True)[:5]
+        update_heroes([int(hero['hero_id']) for hero in top])
+        for hero in top:
             hero_id = hero['hero_id']
             win_rate = hero['win'] * 100 / hero['games']
-            hero_data.append({'name': heroes[int(hero_id)], 'games': hero['games'],
+            hero_data.append({'name': heroes[int(hero_id)], 'games': hero['games'], 'wins': hero['win'],
                               'win_rate': '{:.1f}%'.format(win_rate)})
         return hero_data
 
-    def get_recent_heroes(self, heroes):
-        data = opendota_api_call('players', self.account_id, 'recentMatches')
-
+    def get_recent_heroes(self, heroes, data):
         hero_data = defaultdict(lambda: defaultdict(int))
+        update_heroes([match['hero_id'] for match in data])
         for match in data:
             hero_id = match['hero_id']
             name = heroes[hero_id]
@@ -175,26 +852,454 @@ class Player(object):
         return hero_data
 
 
+class Window(object):
+    def __init__(self, since=None, until=None, patch_id=None):
+        # unix timestamps, until is exclusive
+        self.since = since
+        self.until = until
+        self.patch_id = patch_id
+
+    def contains(self, start_time):
+        # a match without a start time can't be placed, so it is kept
+        if start_time is None:
+            return True
+        if self.since and start_time < self.since:
+            return False
+        if self.until and start_time >= self.until:
+            return False
+        return True
+
+    def get_days(self):
+        if not self.since:
+            return None
+        return max(1, math.ceil((time.time() - self.since) / (24 * 60 * 60)))
+
+    def get_query(self, days=None):
+        # opendota can only filter player queries by days back from today and by patch, until is applied locally
+        query = {}
+        days = [d for d in [days, self.get_days()] if d]
+        if days:
+            query['date'] = min(days)
+        if self.patch_id is not None:
+            query['patch'] = self.patch_id
+        return query
+
+
+class LeagueIndex(object):
+    def __init__(self, league_id, state=None, window=None):
+        self.league_id = league_id
+        self.window = window
+        self.matches = {}
+        self.teams = defaultdict(list)
+        self.last_match_id = None
+        # how far back the history has been paged without gaps, None once it reaches the league's first match
+        self.complete_since = None
+
+        if state:
+            self.load_state(state)
+        with stats.phase('league index'):
+            self.update()
+        if state:
+            self.save_state(state)
+
+    def get_state_key(self):
+        return 'league/{}'.format(self.league_id)
+
+    def load_state(self, state):
+        data = state.get(self.get_state_key())
+        if not data or data.get('version') != STATE_VERSION:
+            return
+
+        for match in data['matches']:
+            self.add_match(match)
+        self.complete_since = data['complete_since']
+        if self.matches:
+            self.last_match_id = max(self.matches)
+
+    def save_state(self, state):
+        state.set(self.get_state_key(), {
+            'version': STATE_VERSION,
+            'complete_since': self.complete_since,
+            'matches': [self.matches[m] for m in sorted(self.matches)],
+        })
+
+    def copy(self):
+        # new history is paged into a copy while teams are still being scouted from this one
+        index = copy.copy(self)
+        index.matches = dict(self.matches)
+        index.teams = defaultdict(list, ((team_id, list(matches)) for team_id, matches in self.teams.items()))
+        return index
+
+    def add_match(self, match):
+        if match['match_id'] in self.matches:
+            return
+        self.matches[match['match_id']] = match
+        self.teams[str(match['radiant_team_id'])].append(match)
+        self.teams[str(match['dire_team_id'])].append(match)
+
+    def update(self, refresh=False):
+        since = self.window.since if self.window else None
+        if not self.matches:
+            self.complete_since = self.page(None, None, since, refresh)
+        else:
+            # match history is newest first, so we can stop at the newest match we already know about --
+            # always from the network, or a cached newest page would hide everything played since
+            complete_since = self.page(None, self.last_match_id, since, True)
+            if complete_since is not None:
+                # stopped at the window before reaching what we knew, so older history now has a gap
+                self.complete_since = max(self.complete_since or 0, complete_since)
+
+            # an earlier run may have stopped paging before this window starts
+            if self.complete_since is not None and (since is None or since < self.complete_since):
+                covered = [m for m, match in self.matches.items()
+                           if (match.get('start_time') or 0) >= self.complete_since]
+                self.complete_since = self.page(min(covered) - 1 if covered else None, None, since, refresh)
+
+        if self.matches:
+            self.last_match_id = max(self.matches)
+
+    def page(self, start_at_match_id, last_match_id, since, refresh):
+        # pages back until the history ends, a known match or the start of the window, and returns
+        # how far back the history is now complete -- None if it reached the end or a known match
+        while True:
+            oldest = self.get_matches(start_at_match_id=start_at_match_id, refresh=refresh)
+            if oldest is None:
+                return None
+            if last_match_id and oldest['match_id'] <= last_match_id:
+                return None
+            if since and oldest['start_time'] and oldest['start_time'] < since:
+                return since
+            start_at_match_id = oldest['match_id'] - 1
+
+    def get_matches(self, start_at_match_id=None, refresh=False):
+        params = {'matches_requested': 1000, 'league_id': self.league_id}
+        if start_at_match_id:
+            params['start_at_match_id'] = start_at_match_id
+
+        data = dota_api_call('GetMatchHistory', refresh=refresh, **params)
+        for match in data['matches']:
+            self.add_match({'match_id': match['match_id'],
+                            'radiant_team_id': match['radiant_team_id'],
+                            'dire_team_id': match['dire_team_id'],
+                            'start_time': match.get('start_time')})
+
+        if not data['matches'] or not data.get('results_remaining', 1):
+            return None
+        oldest = min(data['matches'], key=lambda match: match['match_id'])
+        return {'match_id': oldest['match_id'], 'start_time': oldest.get('start_time')}
+
+    def in_window(self, match):
+        return not self.window or self.window.contains(match.get('start_time'))
+
+    def get_match_ids(self):
+        return sorted(match_id for match_id, match in self.matches.items() if self.in_window(match))
+
+    def get_window_match_ids(self):
+        # None without a window, so callers can tell every match from no matches
+        return set(self.get_match_ids()) if self.window else None
+
+    def get_team_matches(self, team_id):
+        team_id = str(team_id)
+        matches = []
+        for match in self.teams.get(team_id, []):
+            if not self.in_window(match):
+                continue
+            side = 'dire' if str(match['dire_team_id']) == team_id else 'radiant'
+            matches.append(dict(match, side=side))
+        return matches
+
+
+class DraftIndex(object):
+    def __init__(self, league_id, state=None, match_ids=None):
+        self.league_id = league_id
+        self.match_ids = match_ids
+        self.lock = threading.Lock()
+        # every draft is a tuple of tokens from one team's point of view, see get_token
+        self.drafts = defaultdict(dict)
+        self.picks_after_bans = defaultdict(lambda: defaultdict(Counter))
+        self.bans_before_pick = defaultdict(Counter)
+
+        if state:
+            self.load_state(state)
+
+    def get_state_key(self):
+        return 'draft/{}'.format(self.league_id)
+
+    def load_state(self, state):
+        data = state.get(self.get_state_key())
+        if not data or data.get('version') != STATE_VERSION:
+            return
+
+        for team_id, drafts in data['drafts'].items():
+            for match_id, tokens in drafts.items():
+                # drafts outside this run's window are kept for later runs but not counted
+                if self.match_ids is not None and int(match_id) not in self.match_ids:
+                    self.drafts[team_id][int(match_id)] = tuple(tokens)
+                    continue
+                self.add_draft(team_id, int(match_id), tuple(tokens))
+
+    def save_state(self, state):
+        with self.lock:
+            state.set(self.get_state_key(), {'version': STATE_VERSION, 'drafts': self.drafts})
+
+    @staticmethod
+    def get_token(hero_id, is_pick, ours):
+        return hero_id << 2 | is_pick << 1 | ours
+
+    @staticmethod
+    def read_token(token):
+        return token >> 2, bool(token & 2), bool(token & 1)
+
+    def add_match(self, team_id, match_id, picks_bans, team_side_number):
+        tokens = tuple(self.get_token(pb['hero_id'], pb['is_pick'], pb['team'] == team_side_number)
+                       for pb in sorted(picks_bans, key=lambda pb: pb['order']))
+        self.add_draft(str(team_id), match_id, tokens)
+
+    def add_draft(self, team_id, match_id, tokens):
+        with self.lock:
+            if match_id in self.drafts[team_id]:
+                return
+            self.drafts[team_id][match_id] = tokens
+
+            bans = []
+            for token in tokens:
+                hero_id, is_pick, ours = self.read_token(token)
+                if is_pick and ours:
+                    for banned in bans:
+                        self.picks_after_bans[team_id][banned][hero_id] += 1
+                        self.bans_before_pick[team_id][banned] += 1
+                    break
+                if not is_pick:
+                    bans.append(hero_id)
+
+    def get_picks_after_bans(self, team_id, limit=3):
+        team_id = str(team_id)
+        rows = []
+        for banned, times in sorted(self.bans_before_pick[team_id].items(), key=lambda b: (-b[1], b[0])):
+            # ties go by hero id, most_common would keep the order drafts were added in and that differs
+            # between a full and an incremental run
+            picks = self.picks_after_bans[team_id][banned]
+            for hero_id, count in sorted(picks.items(), key=lambda p: (-p[1], p[0]))[:limit]:
+                rows.append((banned, times, hero_id, count))
+        return rows
+
+
+class ParseQueue(object):
+    def __init__(self, state=None, wait=0):
+        self.state = state
+        self.deadline = time.monotonic() + wait
+        self.condition = threading.Condition()
+        self.thread = None
+        self.stopped = False
+        # match id -> opendota job, job_id is None until the parse request has been submitted
+        self.pending = {}
+        self.finished = set()
+        self.failed = set()
+        self.matches = {}
+        self.next_poll = {}
+        self.polls = defaultdict(int)
+
+        if state:
+            self.load_state(state)
+
+    def get_state_key(self):
+        return 'parse_queue'
+
+    def load_state(self, state):
+        data = state.get(self.get_state_key())
+        if not data or data.get('version') != STATE_VERSION:
+            return
+
+        self.pending = {int(match_id): job for match_id, job in data['pending'].items()}
+        self.finished = set(data['finished'])
+        self.failed = set(data['failed'])
+
+    def save_state(self, state):
+        with self.condition:
+            state.set(self.get_state_key(), {
+                'version': STATE_VERSION,
+                'pending': self.pending,
+                'finished': sorted(self.finished),
+                'failed': sorted(self.failed),
+            })
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def close(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        if self.thread:
+            self.thread.join(TIMEOUT)
+        if self.state:
+            self.save_state(self.state)
+
+    def submit(self, match_ids):
+        with self.condition:
+            for match_id in match_ids:
+                if match_id in self.pending or match_id in self.finished or match_id in self.failed:
+                    continue
+                self.pending[match_id] = {'job_id': None, 'attempts': 0}
+            if self.pending:
+                self.start()
+            self.condition.notify_all()
+
+    def get_status(self, match_id):
+        if match_id in self.pending:
+            return 'pending'
+        if match_id in self.failed:
+            return 'failed'
+        return ''
+
+    def get_match(self, match_id):
+        if match_id not in self.finished:
+            return None
+        if match_id not in self.matches:
+            # parsed in an earlier run, the parsed payload is in the cache by now
+            try:
+                self.matches[match_id] = get_match_fields(opendota_api_call('matches', str(match_id)))
+            except Exception:
+                return None
+        if not self.matches[match_id].get('picks_bans'):
+            return None
+        return self.matches[match_id]
+
+    def wait(self, match_ids):
+        # waits until these matches are parsed or the --parse-wait budget for the whole run is used up
+        with self.condition:
+            while any(match_id in self.pending for match_id in match_ids) and not self.stopped:
+                remaining = self.deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                self.condition.wait(remaining)
+
+    def run(self):
+        while True:
+            with self.condition:
+                if self.stopped:
+                    return
+                now = time.monotonic()
+                due = sorted(m for m in self.pending if self.next_poll.get(m, 0) <= now)
+                if not due:
+                    polls = [self.next_poll[m] for m in self.pending if m in self.next_poll]
+                    self.condition.wait(min(polls) - now if polls else None)
+                    continue
+
+            for match_id in due:
+                if self.stopped:
+                    return
+                self.poll(match_id)
+
+    def poll(self, match_id):
+        job = dict(self.pending[match_id])
+        data = None
+        error = None
+        try:
+            if job['job_id'] is None:
+                # counted up front, so a request opendota keeps rejecting is given up on too
+                job['attempts'] += 1
+                job['job_id'] = opendota_parse_request(match_id)
+            elif opendota_parse_done(job['job_id']):
+                data = get_match_fields(opendota_api_call('matches', str(match_id), refresh=True))
+        except Exception as e:
+            error = e
+
+        with self.condition:
+            if data and data.get('picks_bans'):
+                del self.pending[match_id]
+                self.finished.add(match_id)
+                self.matches[match_id] = data
+            elif data and job['attempts'] >= PARSE_ATTEMPTS:
+                # the job is done but the match still has no draft, most likely the replay has expired
+                del self.pending[match_id]
+                self.failed.add(match_id)
+            elif error and job['job_id'] is None and job['attempts'] >= PARSE_ATTEMPTS:
+                print('Could not request a parse of match {}: {}'.format(match_id, error))
+                del self.pending[match_id]
+                self.failed.add(match_id)
+            else:
+                if data:
+                    job['job_id'] = None
+                self.pending[match_id] = job
+                self.next_poll[match_id] = time.monotonic() + min(PARSE_MAX_BACKOFF,
+                                                                  PARSE_BACKOFF * 2 ** self.polls[match_id])
+                self.polls[match_id] += 1
+            self.condition.notify_all()
+
+
 class Team(object):
-    def __init__(self, team_id, player_names, heroes, league_id):
-        if not league_id:
+    def __init__(self, team_id, player_names, heroes, league_index, workers=WORKERS, state=None, draft_index=None,
+                 parse_queue=None):
+        if not league_index:
             raise Exception('league_id required for team scouting')
 
         self.team_id = team_id
         self.player_names = player_names
         self.heroes = heroes
+        self.workers = workers
+        self.state = state
+        self.league_id = league_index.league_id
+        self.draft_index = draft_index
+        self.parse_queue = parse_queue
         self.parsed_matches = []
         self.unparsed_matches = []
-        self.pick_count = defaultdict(lambda: defaultdict(int))
-        self.ban_count = defaultdict(int)
-        self.banned_against_count = defaultdict(int)
+        size = max(heroes) + 1
+        self.pick_count = HeroCounter(size)
+        self.pick_wins = HeroCounter(size)
+        self.ban_count = HeroCounter(size)
+        self.banned_against_count = HeroCounter(size)
         self.players = []
+        # saved matches outside this run's window, kept as they were so the next run still has them
+        self.other_matches = {'parsed_matches': [], 'unparsed_matches': []}
 
         self.get_team_data()
-        self.parse_matches(self.get_team_matches(league_id=league_id))
+        if state:
+            self.load_state(state, self.league_id, league_index.get_window_match_ids())
+        self.parse_matches(self.get_team_matches(league_index))
+        if state:
+            self.save_state(state, self.league_id)
+
+    def get_state_key(self, league_id):
+        return 'team/{}/{}'.format(league_id, self.team_id)
+
+    def load_state(self, state, league_id, match_ids=None):
+        data = state.get(self.get_state_key(league_id))
+        if not data or data.get('version') != STATE_VERSION:
+            return
+
+        for field, cls in [('parsed_matches', ParsedMatch), ('unparsed_matches', UnparsedMatch)]:
+            matches = []
+            for summary in data[field]:
+                if match_ids is not None and summary['match_id'] not in match_ids:
+                    self.other_matches[field].append(summary)
+                else:
+                    matches.append(cls.from_summary(summary))
+            setattr(self, field, matches)
+
+        # counts are rebuilt rather than saved, since the window decides which matches they cover
+        for match in self.parsed_matches:
+            self.count_picks(match)
+            self.count_bans(match)
+        for match in self.unparsed_matches:
+            self.count_picks(match)
+
+    def save_state(self, state, league_id):
+        # drafts go first, saved matches are never fetched again so their drafts can't be rebuilt later
+        if self.draft_index:
+            self.draft_index.save_state(state)
+        state.set(self.get_state_key(league_id), {
+            'version': STATE_VERSION,
+            'parsed_matches': [m.get_summary() for m in self.parsed_matches] + self.other_matches['parsed_matches'],
+            'unparsed_matches': ([m.get_summary() for m in self.unparsed_matches] +
+                                 self.other_matches['unparsed_matches']),
+        })
 
     def get_team_data(self):
-        data = dota_api_call('GetTeamInfoByTeamID', start_at_team_id=self.team_id, teams_requested=1)
+        with stats.phase('team info'):
+            data = dota_api_call('GetTeamInfoByTeamID', start_at_team_id=self.team_id, teams_requested=1)
         if not data['teams']:
             raise Exception('Team with ID {} not found.'.format(self.team_id))
 
@@ -204,70 +1309,354 @@ class Team(object):
                 continue
             value = str(value)
             self.players.append(value)
-            sleep(.5)
 
-    def get_team_matches(self, league_id):
-        matches = set()
-        while True:
-            if matches:
-                matches_min = min(matches, key=lambda m: m[0])[0] - 1
-            else:
-                matches_min = None
+    def get_team_matches(self, league_index):
+        # only matches we don't have yet, and the league index leaves out anything outside the window --
+        # saved unparsed matches are fetched again, opendota may have parsed them since
+        known = {m.match_id for m in self.parsed_matches}
+        return {match['match_id'] for match in league_index.get_team_matches(self.team_id)
+                if match['match_id'] not in known}
 
-            new_matches = self.get_matches(matches, league_id=league_id, start_at_match_id=matches_min)
-            if len(matches) == len(new_matches):
-                return matches
-            matches = new_matches
-        return matches
+    def fetch_match(self, match):
+        try:
+            return get_match_fields(opendota_api_call('matches', str(match)))
+        except Exception:
+            print('match {} could not be found using dotabuff api'.format(match))
+            return None
 
-    def get_matches(self, matches, league_id, start_at_match_id=None):
-        params = {'matches_requested': 1000, 'league_id': league_id}
-        if start_at_match_id:
-            params['start_at_match_id'] = start_at_match_id
+    def parse_matches(self, matches):
+        self.add_matches(self.fetch_matches(matches))
 
-        data = dota_api_call('GetMatchHistory', **params)
-        for match in data['matches']:
-            if int(self.team_id) in [match['dire_team_id'], match['radiant_team_id']]:
-                matches.add(match['match_id'])
-        return matches
+    def update(self, league_index):
+        return self.fetch_matches(self.get_team_matches(league_index))
 
-    def parse_matches(self, matches):
-        for match in sorted(matches, reverse=True):
-            try:
-                data = opendota_api_call('matches', str(match))
-            except:
-                print('match {} could not be found using dotabuff api'.format(match))
+    def fetch_matches(self, matches):
+        # download everything up front, then build matches in the same order a serial run would
+        with stats.phase('matches'), ThreadPoolExecutor(max_workers=self.workers) as executor:
+            return list(executor.map(self.fetch_match, sorted(matches, reverse=True)))
+
+    def add_matches(self, fetched):
+        parsed_matches, unparsed_matches = [], []
+        saved = {m.match_id: m for m in self.unparsed_matches}
+        for data in fetched:
+            if data is None:
+                continue
             if data.get('picks_bans'):
-                match_details = ParsedMatch(data, self.team_id, self.player_names, self.heroes)
-                for hero in match_details.picks.values():
-                    self.pick_count[hero['name']]['count'] += 1
-                    if match_details.win:
-                        self.pick_count[hero['name']]['wins'] += 1
-                for hero in match_details.banned_against.values():
-                    self.banned_against_count[hero['name']] += 1
-                for hero in match_details.bans.values():
-                    self.ban_count[hero['name']] += 1
-                self.parsed_matches.append(match_details)
-            else:
-                match_details = UnparsedMatch(data, self.team_id, self.player_names, self.heroes, self.players)
-                self.unparsed_matches.append(match_details)
-                for hero in match_details.picks.values():
-                    self.pick_count[hero['name']]['count'] += 1
-                    if match_details.win:
-                        self.pick_count[hero['name']]['wins'] += 1
+                # a saved unparsed match that has been parsed since replaces the unparsed one
+                if data['match_id'] in saved:
+                    self.count_picks(saved.pop(data['match_id']), -1)
+                parsed_matches.append(self.add_parsed_match(data))
+            elif data['match_id'] not in saved:
+                match_details = UnparsedMatch(data, self.team_id, self.player_names, self.players)
+                unparsed_matches.append(match_details)
+                self.count_picks(match_details)
+
+        # a wider window can add matches older than the saved ones, so keep everything newest first
+        self.parsed_matches = sorted(parsed_matches + self.parsed_matches, key=lambda m: m.match_id, reverse=True)
+        self.unparsed_matches = sorted(unparsed_matches + list(saved.values()), key=lambda m: m.match_id,
+                                       reverse=True)
+        if self.parse_queue:
+            self.parse_queue.submit([m.match_id for m in self.unparsed_matches])
+
+    def add_parsed_match(self, data):
+        match_details = ParsedMatch(data, self.team_id, self.player_names)
+        if self.draft_index:
+            self.draft_index.add_match(self.team_id, match_details.match_id, data['picks_bans'],
+                                       match_details.team_side_number)
+        self.count_picks(match_details)
+        self.count_bans(match_details)
+        return match_details
+
+    def apply_parses(self):
+        self.add_parses(self.fetch_parses())
+
+    def fetch_parses(self):
+        # the matches opendota has parsed since, paired with their parsed payload
+        if not self.parse_queue or not self.unparsed_matches:
+            return []
+
+        with stats.phase('parse wait'):
+            self.parse_queue.wait([m.match_id for m in self.unparsed_matches])
+        parses = [(match, self.parse_queue.get_match(match.match_id)) for match in self.unparsed_matches]
+        return [(match, data) for match, data in parses if data is not None]
+
+    def add_parses(self, parses):
+        if not parses:
+            return
+
+        for match, data in parses:
+            self.count_picks(match, -1)
+            self.parsed_matches.append(self.add_parsed_match(data))
+        parsed = {match.match_id for match, _ in parses}
+        self.unparsed_matches = [m for m in self.unparsed_matches if m.match_id not in parsed]
+        self.parsed_matches.sort(key=lambda m: m.match_id, reverse=True)
+        if self.state:
+            self.save_state(self.state, self.league_id)
+
+    def resolve_columns(self, columns):
+        # optional columns are only looked up once we know the report needs them, and before it is
+        # written so the lookups aren't timed as workbook writing
+        self.apply_parses()
+        self.add_names(self.fetch_names(columns))
+
+    def fetch_names(self, columns):
+        # everything the optional columns need from the network, without changing any match yet so
+        # a server can keep reporting on them meanwhile -- add_names fills them in
+        captains = self.fetch_captains() if 'captain' in columns else []
+        pick_names = self.fetch_pick_names() if 'players' in columns else []
+        return captains, pick_names
+
+    def add_names(self, names):
+        captains, pick_names = names
+        for match, captain_id, captain in captains:
+            match.enemy_captain_id = captain_id
+            match.enemy_captain = captain
+        for pick, name in pick_names:
+            pick.player_name = name
+
+    def fetch_captains(self):
+        matches = [m for m in self.parsed_matches if m.enemy_captain is None]
+        if not matches:
+            return []
+
+        # opendota usually has the captains already, steam is only asked about the rest
+        captain_ids = {m.match_id: m.enemy_captain_id for m in matches}
+        lookups = [m for m in matches if m.enemy_captain_id is None]
+        with stats.phase('captains'), ThreadPoolExecutor(max_workers=self.workers) as executor:
+            details = executor.map(lambda m: dota_api_call('GetMatchDetails', match_id=m.match_id), lookups)
+            for match, data in zip(lookups, details):
+                captain_ids[match.match_id] = get_enemy_captain_id(data, match.side) or 0
+
+        resolve_player_names(captain_ids.values(), self.player_names)
+        return [(m, captain_ids[m.match_id],
+                 get_player_name(captain_ids[m.match_id], self.player_names) if captain_ids[m.match_id] else '')
+                for m in matches]
+
+    def fetch_pick_names(self):
+        picks = [pick for match in self.parsed_matches + self.unparsed_matches for pick in match.picks.values()
+                 if pick.player_name is None and pick.account_id]
+        resolve_player_names([pick.account_id for pick in picks], self.player_names)
+        return [(pick, get_player_name(pick.account_id, self.player_names)) for pick in picks]
+
+    def count_picks(self, match, value=1):
+        for hero_id in match.picks:
+            self.pick_count.add(hero_id, value)
+            if match.win:
+                self.pick_wins.add(hero_id, value)
+
+    def count_bans(self, match):
+        for hero_id in match.banned_against:
+            self.banned_against_count.add(hero_id)
+        for hero_id in match.bans:
+            self.ban_count.add(hero_id)
+
+
+def import_numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise Exception('--analytics needs numpy -- install it with pip install numpy')
+    return numpy
+
+
+def import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise Exception('--format parquet needs pyarrow -- install it with pip install pyarrow')
+    return pyarrow
+
+
+class LeagueAnalytics(object):
+    def __init__(self, league_index, heroes, workers=WORKERS, min_games=ANALYTICS_MIN_GAMES):
+        self.league_id = league_index.league_id
+        self.heroes = heroes
+        self.min_games = min_games
+
+        with stats.phase('analytics'):
+            self.load(self.fetch_matches(league_index, workers))
+            self.analyze()
+
+    def fetch_match(self, match_id):
+        try:
+            return get_match_fields(opendota_api_call('matches', str(match_id)))
+        except Exception:
+            return None
+
+    def fetch_matches(self, league_index, workers):
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return [m for m in executor.map(self.fetch_match, league_index.get_match_ids()) if m and m['picks_bans']]
+
+    def load(self, matches):
+        # one row per pick or ban: match index, hero id, team, is pick, order
+        np = import_numpy()
+        rows = [(i, pb['hero_id'], pb['team'], pb['is_pick'], pb['order'])
+                for i, match in enumerate(matches) for pb in match['picks_bans']]
+        table = np.array(rows, dtype=np.int64).reshape(-1, 5)
+
+        self.match_count = len(matches)
+        self.match_index, self.hero_id, self.team, is_pick, self.order = table.T
+        self.is_pick = is_pick.astype(bool)
+        self.radiant_win = np.array([bool(match['radiant_win']) for match in matches], dtype=bool)
+        self.size = max(max(self.heroes), int(self.hero_id.max(initial=0))) + 1
+
+    def analyze(self):
+        np = import_numpy()
+        count, size = self.match_count, self.size
+        pick, ban = self.is_pick, ~self.is_pick
+
+        # picks[side, match, hero] and the same masked to the games that side won
+        picks = np.zeros((2, count, size), dtype=np.int64)
+        picks[self.team[pick], self.match_index[pick], self.hero_id[pick]] = 1
+        side_won = np.stack([self.radiant_win, ~self.radiant_win]).astype(np.int64)
+        wins = picks * side_won[:, :, None]
+        picked = picks.sum(axis=0) > 0
+
+        banned = np.zeros((count, size), dtype=bool)
+        banned[self.match_index[ban], self.hero_id[ban]] = True
+
+        self.pick_count = picks.sum(axis=(0, 1))
+        self.win_count = wins.sum(axis=(0, 1))
+        self.ban_count = np.bincount(self.hero_id[ban], minlength=size)
+        self.contest_count = (picked | banned).sum(axis=0)
+
+        # bans made before the first pick of a match are first phase bans
+        first_pick_order = np.full(count, np.iinfo(np.int64).max)
+        np.minimum.at(first_pick_order, self.match_index[pick], self.order[pick])
+        first_phase = ban & (self.order < first_pick_order[self.match_index])
+        self.first_phase_ban_count = np.bincount(self.hero_id[first_phase], minlength=size)
+        self.later_ban_count = self.ban_count - self.first_phase_ban_count
+
+        # [a, b] is games (and wins) where a was picked with, or against, b
+        self.together = picks[0].T @ picks[0] + picks[1].T @ picks[1]
+        self.together_wins = picks[0].T @ wins[0] + picks[1].T @ wins[1]
+        self.against = picks[0].T @ picks[1] + picks[1].T @ picks[0]
+        self.against_wins = wins[0].T @ picks[1] + wins[1].T @ picks[0]
+
+    def get_rate(self, count, total):
+        return '{:.1f}%'.format(count * 100 / total) if total else ''
+
+    def get_heroes(self):
+        rows = []
+        for hero_id in sorted(self.heroes, key=lambda h: (-self.contest_count[h], self.heroes[h])):
+            if not self.contest_count[hero_id]:
+                continue
+            rows.append([self.heroes[hero_id],
+                         int(self.pick_count[hero_id]), self.get_rate(self.pick_count[hero_id], self.match_count),
+                         int(self.ban_count[hero_id]), self.get_rate(self.ban_count[hero_id], self.match_count),
+                         self.get_rate(self.contest_count[hero_id], self.match_count),
+                         int(self.win_count[hero_id]), self.get_rate(self.win_count[hero_id], self.pick_count[hero_id]),
+                         int(self.first_phase_ban_count[hero_id]), int(self.later_ban_count[hero_id])])
+        return rows
+
+    def get_pairs(self, games, wins, unique):
+        np = import_numpy()
+        if unique:
+            games = np.triu(games, 1)
+        first, second = np.nonzero(games >= self.min_games)
+        order = np.lexsort((-wins[first, second] / games[first, second], -games[first, second]))
+
+        rows = []
+        for a, b in zip(first[order], second[order]):
+            if a not in self.heroes or b not in self.heroes:
+                continue
+            rows.append([self.heroes[a], self.heroes[b], int(games[a, b]), int(wins[a, b]),
+                         self.get_rate(wins[a, b], games[a, b])])
+        return rows
+
+    def get_synergy(self):
+        return self.get_pairs(self.together, self.together_wins, unique=True)
+
+    def get_counters(self):
+        return self.get_pairs(self.against, self.against_wins, unique=False)
 
 
 class XlsxWriter(object):
-    def __init__(self, file):
-        self.workbook = xlsxwriter.Workbook(file)
-        self.worksheet = self.workbook.add_worksheet()
+    def __init__(self, file, constant_memory=False, sheet_name=None, columns=DEFAULT_COLUMNS):
+        # in constant memory mode each row is flushed to disk once a later row is started,
+        # so everything below has to be written top to bottom
+        import xlsxwriter
+
+        # file can also be a BytesIO, which is written to without temporary files
+        self.workbook = xlsxwriter.Workbook(file, {'constant_memory': constant_memory,
+                                                   'in_memory': not isinstance(file, str)})
+        self.columns = columns
+        self.sheet_names = set()
         self.colors = self.create_colors()
-        self.used_colors = set()
-        self.row = 0
+        self.overview = None
+        self.overview_row = 0
+        self.add_worksheet(sheet_name)
 
     def close(self):
         self.workbook.close()
 
+    def add_worksheet(self, name=None):
+        if name:
+            name = self.get_sheet_name(name)
+        self.worksheet = self.workbook.add_worksheet(name)
+        self.used_colors = set()
+        self.row = 0
+
+    def get_sheet_name(self, name):
+        name = ''.join(c for c in name if c not in INVALID_SHEET_NAME_CHARACTERS)[:SHEET_NAME_LENGTH] or 'Sheet'
+        unique_name, number = name, 2
+        while unique_name.lower() in self.sheet_names:
+            suffix = ' ({})'.format(number)
+            unique_name = name[:SHEET_NAME_LENGTH - len(suffix)] + suffix
+            number += 1
+        self.sheet_names.add(unique_name.lower())
+        return unique_name
+
+    def write_table(self, headers, rows):
+        for column, header in enumerate(headers):
+            self.worksheet.write(self.row, column, header)
+        self.row += 1
+
+        for values in rows:
+            for column, value in enumerate(values):
+                self.worksheet.write(self.row, column, value)
+            self.row += 1
+        self.row += 1
+
+    def write_analytics(self, analytics):
+        self.add_worksheet('HERO META {}'.format(analytics.league_id))
+        self.worksheet.write(self.row, 0, '{} MATCHES'.format(analytics.match_count))
+        self.row += 2
+        self.write_table(['HERO', 'PICKS', 'PICK RATE', 'BANS', 'BAN RATE', 'CONTEST RATE', 'WINS', 'WIN RATE',
+                          'FIRST PHASE BANS', 'LATER BANS'], analytics.get_heroes())
+
+        self.add_worksheet('SYNERGY {}'.format(analytics.league_id))
+        self.write_table(['HERO', 'WITH', 'GAMES', 'WINS', 'WIN RATE'], analytics.get_synergy())
+
+        self.add_worksheet('COUNTERS {}'.format(analytics.league_id))
+        self.write_table(['HERO', 'AGAINST', 'GAMES', 'WINS', 'WIN RATE'], analytics.get_counters())
+
+    def write_overview_header(self):
+        self.overview = self.worksheet
+        self.overview.write(0, 0, 'TEAM')
+        self.overview.write(0, 1, 'LEAGUE')
+        self.overview.write(0, 2, 'MATCHES')
+        self.overview.write(0, 3, 'WINS')
+        self.overview.write(0, 4, 'WIN RATE')
+        self.overview.write(0, 5, 'MOST PICKED')
+        self.overview.write(0, 6, 'MOST BANNED')
+        self.overview.write(0, 7, 'MOST BANNED AGAINST')
+        self.overview_row = 1
+
+    def write_overview(self, team, league_id):
+        matches = team.parsed_matches + team.unparsed_matches
+        wins = sum(1 for match in matches if match.win)
+        self.overview.write(self.overview_row, 0, team.name)
+        self.overview.write(self.overview_row, 1, league_id)
+        self.overview.write(self.overview_row, 2, len(matches))
+        self.overview.write(self.overview_row, 3, wins)
+        self.overview.write(self.overview_row, 4, '{:.1f}%'.format(wins * 100 / len(matches)) if matches else '')
+        for column, counter in enumerate([team.pick_count, team.ban_count, team.banned_against_count], start=5):
+            top = self.sort_counts(counter, team.heroes)[:3]
+            self.overview.write(self.overview_row, column, ', '.join('{} ({})'.format(team.heroes[h], c) for h, c in top))
+        self.overview_row += 1
+
     def create_colors(self):
         colors = {}
         for num, color in enumerate(COLORS, start=1):
@@ -285,7 +1674,8 @@ class XlsxWriter(object):
             self.worksheet.write(self.row, 5, 'PICK')
             self.worksheet.write(self.row, 6, 'RESULT')
             self.worksheet.write(self.row, 7, 'SIDE')
-            self.worksheet.write(self.row, 8, 'CAPTAIN')
+            if 'captain' in self.columns:
+                self.worksheet.write(self.row, 8, 'CAPTAIN')
             self.worksheet.write(self.row, 9, 'BANNED AGAINST')
             self.worksheet.write(self.row, 16, 'BANS')
             self.worksheet.write(self.row, 23, 'DOTABUFF')
@@ -297,6 +1687,8 @@ class XlsxWriter(object):
             self.worksheet.write(self.row, 5, 'RESULT')
             self.worksheet.write(self.row, 6, 'SIDE')
             self.worksheet.write(self.row, 7, 'DOTABUFF')
+            if team.parse_queue:
+                self.worksheet.write(self.row, 8, 'PARSE')
             self.row += 1
             self.write_unparsed_matches(team)
 
@@ -308,26 +1700,27 @@ class XlsxWriter(object):
         self.row += 1
 
     def write_parsed_match(self, match, team):
-        for column, pick in enumerate(sorted(match.picks.values(), key=lambda p: p['order'])):
-            count = team.pick_count[pick['name']]['count']
+        for column, pick in enumerate(sorted(match.picks.values(), key=lambda p: p.order)):
+            count = team.pick_count[pick.hero_id]
             color = self.colors.get(count, self.colors[1])
             self.used_colors.add(count)
-            self.write_hero(column, color, **pick)
+            self.write_hero(column, color, team.heroes[pick.hero_id], pick)
 
         self.worksheet.write(self.row, 5, 'FP' if match.first_pick else 'SP')
         self.worksheet.write(self.row, 6, 'W' if match.win else 'L')
         self.worksheet.write(self.row, 7, match.side)
-        self.worksheet.write(self.row, 8, match.enemy_captain)
+        if 'captain' in self.columns:
+            self.worksheet.write(self.row, 8, match.enemy_captain)
 
-        for column, ban in enumerate(sorted(match.banned_against.values(), key=lambda p: p['order']), start=9):
-            color = self.colors.get(team.banned_against_count[ban['name']], self.colors[1])
-            self.used_colors.add(team.banned_against_count[ban['name']])
-            self.write_hero(column, color, **ban)
+        for column, ban in enumerate(sorted(match.banned_against.values(), key=lambda p: p.order), start=9):
+            color = self.colors.get(team.banned_against_count[ban.hero_id], self.colors[1])
+            self.used_colors.add(team.banned_against_count[ban.hero_id])
+            self.write_hero(column, color, team.heroes[ban.hero_id], ban)
 
-        for column, ban in enumerate(sorted(match.bans.values(), key=lambda p: p['order']), start=16):
-            color = self.colors.get(team.ban_count[ban['name']], self.colors[1])
-            self.used_colors.add(team.ban_count[ban['name']])
-            self.write_hero(column, color, **ban)
+        for column, ban in enumerate(sorted(match.bans.values(), key=lambda p: p.order), start=16):
+            color = self.colors.get(team.ban_count[ban.hero_id], self.colors[1])
+            self.used_colors.add(team.ban_count[ban.hero_id])
+            self.write_hero(column, color, team.heroes[ban.hero_id], ban)
 
         self.worksheet.write(self.row, 23, 'http://www.dotabuff.com/matches/{}'.format(match.match_id))
 
@@ -339,15 +1732,17 @@ class XlsxWriter(object):
         self.row += 1
 
     def write_unparsed_match(self, match, team):
-        for column, pick in enumerate(sorted(match.picks.values(), key=lambda p: p['lane'])):
-            count = team.pick_count[pick['name']]['count']
+        for column, pick in enumerate(sorted(match.picks.values(), key=lambda p: p.lane)):
+            count = team.pick_count[pick.hero_id]
             color = self.colors.get(count, self.colors[1])
             self.used_colors.add(count)
-            self.write_hero(column, color, **pick)
+            self.write_hero(column, color, team.heroes[pick.hero_id], pick)
 
         self.worksheet.write(self.row, 5, 'W' if match.win else 'L')
         self.worksheet.write(self.row, 6, match.side)
         self.worksheet.write(self.row, 7, 'http://www.dotabuff.com/matches/{}'.format(match.match_id))
+        if team.parse_queue:
+            self.worksheet.write(self.row, 8, team.parse_queue.get_status(match.match_id).upper())
 
     def write_summary(self, team):
         self.worksheet.write(self.row, 0, 'SUMMARY')
@@ -366,30 +1761,32 @@ class XlsxWriter(object):
         self.row += 1
 
         pick_row, banned_against_row, ban_row = self.row, self.row, self.row
-        pick_count = sorted(team.pick_count.items(), key=lambda p: p[1]['count'], reverse=True)
-        banned_against_count = sorted(team.banned_against_count.items(), key=lambda b: b[1], reverse=True)
-        ban_count = sorted(team.ban_count.items(), key=lambda b: b[1], reverse=True)
+        pick_count = self.sort_counts(team.pick_count, team.heroes)
+        banned_against_count = self.sort_counts(team.banned_against_count, team.heroes)
+        ban_count = self.sort_counts(team.ban_count, team.heroes)
 
         for pick, banned_against, ban in zip_longest(pick_count, banned_against_count, ban_count):
             if pick:
-                win_rate = '{:.1f}%'.format(pick[1]['wins'] * 100 / pick[1]['count'])
-                if pick[1]['wins'] == pick[1]['count']:
-                    self.worksheet.write(pick_row, 0, pick[0], self.colors[2])
-                    self.worksheet.write(pick_row, 1, pick[1]['count'], self.colors[2])
-                    self.worksheet.write(pick_row, 2, pick[1]['wins'], self.colors[2])
+                hero_id, count = pick
+                wins = team.pick_wins[hero_id]
+                win_rate = '{:.1f}%'.format(wins * 100 / count)
+                if wins == count:
+                    self.worksheet.write(pick_row, 0, team.heroes[hero_id], self.colors[2])
+                    self.worksheet.write(pick_row, 1, count, self.colors[2])
+                    self.worksheet.write(pick_row, 2, wins, self.colors[2])
                     self.worksheet.write(pick_row, 3, win_rate, self.colors[2])
                 else:
-                    self.worksheet.write(pick_row, 0, pick[0])
-                    self.worksheet.write(pick_row, 1, pick[1]['count'])
-                    self.worksheet.write(pick_row, 2, pick[1]['wins'])
+                    self.worksheet.write(pick_row, 0, team.heroes[hero_id])
+                    self.worksheet.write(pick_row, 1, count)
+                    self.worksheet.write(pick_row, 2, wins)
                     self.worksheet.write(pick_row, 3, win_rate)
                 pick_row += 1
             if banned_against:
-                self.worksheet.write(banned_against_row, 5, banned_against[0])
+                self.worksheet.write(banned_against_row, 5, team.heroes[banned_against[0]])
                 self.worksheet.write(banned_against_row, 6, banned_against[1])
                 banned_against_row += 1
             if ban:
-                self.worksheet.write(ban_row, 8, ban[0])
+                self.worksheet.write(ban_row, 8, team.heroes[ban[0]])
                 self.worksheet.write(ban_row, 9, ban[1])
                 ban_row += 1
 
@@ -397,14 +1794,41 @@ class XlsxWriter(object):
         self.row += 1
 
 
-    def write_hero(self, column, color, name=None, lane=None, roaming=False, **kwargs):
+    def sort_counts(self, counter, heroes):
+        return sorted(counter.items(), key=lambda c: (-c[1], heroes[c[0]]))
+
+    def write_drafts(self, team):
+        rows = team.draft_index.get_picks_after_bans(team.team_id)
+        if not rows:
+            return
+
+        self.worksheet.write(self.row, 0, 'FIRST PICK AFTER BAN')
+        self.row += 1
+        self.worksheet.write(self.row, 0, 'BANNED')
+        self.worksheet.write(self.row, 1, 'TIMES')
+        self.worksheet.write(self.row, 2, 'THEY PICK')
+        self.worksheet.write(self.row, 3, 'COUNT')
+        self.row += 1
+
+        for banned, times, hero_id, count in rows:
+            self.worksheet.write(self.row, 0, team.heroes[banned])
+            self.worksheet.write(self.row, 1, times)
+            self.worksheet.write(self.row, 2, team.heroes[hero_id])
+            self.worksheet.write(self.row, 3, count)
+            self.row += 1
+        self.row += 1
+
+    def write_hero(self, column, color, name, pick):
         data = name
-        if lane:
-            data += ' ' + lane
+        if pick.lane:
+            data += ' ' + pick.lane
 
-        if roaming:
+        if pick.roaming:
             data += ' (R)'
 
+        if pick.player_name and 'players' in self.columns:
+            data += ' - ' + pick.player_name
+
         self.worksheet.write(self.row, column, data, color)
 
     def write_legend(self):
@@ -467,6 +1891,488 @@ class XlsxWriter(object):
         self.row += 1
 
 
+class TableWriter(object):
+    extension = None
+
+    # writes the raw tables behind a report, one file per table, flushing each table in batches as it fills up
+    def __init__(self, directory, columns=DEFAULT_COLUMNS, batch_size=TABLE_BATCH):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.columns = columns
+        self.batch_size = batch_size
+        self.batches = defaultdict(list)
+        self.files = {}
+
+    def get_file(self, table):
+        return os.path.join(self.directory, '{}.{}'.format(table, self.extension))
+
+    def write_rows(self, table, rows):
+        batch = self.batches[table]
+        batch.extend(rows)
+        if len(batch) >= self.batch_size:
+            self.flush(table)
+
+    def flush(self, table):
+        rows = self.batches.pop(table, [])
+        if table not in self.files:
+            self.files[table] = self.open(table)
+        if rows:
+            self.write_batch(self.files[table], table, rows)
+
+    def close(self):
+        # every table is written even when it is empty, so downstream queries don't have to check
+        for table in TABLES:
+            self.flush(table)
+        for table, f in self.files.items():
+            self.close_file(f)
+
+    def open(self, table):
+        raise NotImplementedError
+
+    def write_batch(self, f, table, rows):
+        raise NotImplementedError
+
+    def close_file(self, f):
+        f.close()
+
+    # the layout-only parts of a report have nothing to export
+    def add_worksheet(self, name=None):
+        pass
+
+    def write_overview_header(self):
+        pass
+
+    def write_overview(self, team, league_id):
+        pass
+
+    def write_legend(self):
+        pass
+
+    def write_matches(self, team):
+        league_id, team_id = int(team.league_id), int(team.team_id)
+        captain = 'captain' in self.columns
+        matches, picks_bans = [], []
+        for match in team.parsed_matches:
+            matches.append([league_id, team_id, team.name, match.match_id, True, match.side, match.win,
+                            match.first_pick, (match.enemy_captain_id or None) if captain else None,
+                            (match.enemy_captain or None) if captain else None, None])
+            for kind, picks in [('pick', match.picks), ('ban', match.bans), ('banned_against', match.banned_against)]:
+                picks_bans.extend(self.get_pick_row(league_id, team_id, match, kind, pick, team.heroes)
+                                  for pick in sorted(picks.values(), key=lambda p: p.order))
+
+        for match in team.unparsed_matches:
+            status = (team.parse_queue.get_status(match.match_id) or None) if team.parse_queue else None
+            matches.append([league_id, team_id, team.name, match.match_id, False, match.side, match.win,
+                            None, None, None, status])
+            picks_bans.extend(self.get_pick_row(league_id, team_id, match, 'pick', pick, team.heroes)
+                              for pick in sorted(match.picks.values(), key=lambda p: p.lane))
+
+        self.write_rows('matches', matches)
+        self.write_rows('picks_bans', picks_bans)
+
+    def get_pick_row(self, league_id, team_id, match, kind, pick, heroes):
+        player = pick.player_name if 'players' in self.columns else None
+        return [league_id, team_id, match.match_id, kind, pick.order, pick.hero_id, heroes[pick.hero_id], pick.lane,
+                pick.roaming, pick.account_id, player]
+
+    def write_summary(self, team):
+        league_id, team_id = int(team.league_id), int(team.team_id)
+        hero_ids = {hero_id for counter in [team.pick_count, team.ban_count, team.banned_against_count]
+                    for hero_id, _ in counter.items()}
+        self.write_rows('team_heroes', [[league_id, team_id, team.name, hero_id, team.heroes[hero_id],
+                                         team.pick_count[hero_id], team.pick_wins[hero_id], team.ban_count[hero_id],
+                                         team.banned_against_count[hero_id]] for hero_id in sorted(hero_ids)])
+
+    def write_drafts(self, team):
+        league_id, team_id = int(team.league_id), int(team.team_id)
+        self.write_rows('drafts', [[league_id, team_id, team.heroes[banned], times, team.heroes[hero_id], count]
+                                   for banned, times, hero_id, count
+                                   in team.draft_index.get_picks_after_bans(team.team_id)])
+
+    def write_players(self, players, highlight_heroes):
+        for player in sorted(players, key=lambda p: p.name.lower()):
+            account_id = int(player.account_id)
+            self.write_rows('player_heroes', [[account_id, player.name, hero['name'], hero['games'], hero['wins'],
+                                               hero['name'].lower() in highlight_heroes] for hero in player.heroes])
+            self.write_rows('player_recent_heroes', [[account_id, player.name, hero, data['count'], data['wins'],
+                                                      hero.lower() in highlight_heroes]
+                                                     for hero, data in sorted(player.recent_heroes.items())])
+
+    def write_analytics(self, analytics):
+        # the rates in the sheets are left out, they are just the counts divided by games
+        league_id = int(analytics.league_id)
+        self.write_rows('hero_meta', [[league_id, analytics.match_count, row[0], row[1], row[3], row[6], row[8], row[9]]
+                                      for row in analytics.get_heroes()])
+        self.write_rows('synergy', [[league_id] + row[:4] for row in analytics.get_synergy()])
+        self.write_rows('counters', [[league_id] + row[:4] for row in analytics.get_counters()])
+
+
+class CsvWriter(TableWriter):
+    extension = 'csv'
+
+    def open(self, table):
+        f = open(self.get_file(table), 'w', newline='')
+        csv.writer(f).writerow([name for name, _ in TABLES[table]])
+        return f
+
+    def write_batch(self, f, table, rows):
+        csv.writer(f).writerows(rows)
+
+
+class JsonLinesWriter(TableWriter):
+    extension = 'jsonl'
+
+    def open(self, table):
+        return open(self.get_file(table), 'w')
+
+    def write_batch(self, f, table, rows):
+        names = [name for name, _ in TABLES[table]]
+        f.writelines(json.dumps(dict(zip(names, row))) + '\n' for row in rows)
+
+
+class ParquetWriter(TableWriter):
+    extension = 'parquet'
+
+    def __init__(self, directory, columns=DEFAULT_COLUMNS, batch_size=TABLE_BATCH):
+        self.pyarrow = import_pyarrow()
+        TableWriter.__init__(self, directory, columns=columns, batch_size=batch_size)
+
+    def get_schema(self, table):
+        pa = self.pyarrow
+        types = {'int': pa.int64(), 'str': pa.string(), 'bool': pa.bool_()}
+        return pa.schema([(name, types[column_type]) for name, column_type in TABLES[table]])
+
+    def open(self, table):
+        # each flushed batch becomes its own row group, so nothing is held in memory between flushes
+        return self.pyarrow.parquet.ParquetWriter(self.get_file(table), self.get_schema(table))
+
+    def write_batch(self, f, table, rows):
+        f.write_table(self.pyarrow.Table.from_pylist([dict(zip(f.schema.names, row)) for row in rows],
+                                                     schema=self.get_schema(table)))
+
+
+WRITERS = {'csv': CsvWriter, 'jsonl': JsonLinesWriter, 'parquet': ParquetWriter}
+
+
+def get_writer(output_format, file, columns, constant_memory=False, sheet_name=None):
+    if output_format == 'xlsx':
+        return XlsxWriter(file, constant_memory=constant_memory, sheet_name=sheet_name, columns=columns)
+    return WRITERS[output_format](file, columns=columns)
+
+
+def read_manifest(file):
+    with open(file) as f:
+        manifest = json.load(f)
+
+    teams = [(str(team['league_id']), str(team['team_id'])) for team in manifest.get('teams', [])]
+    players = [str(player) for player in manifest.get('players', [])]
+    return teams, players
+
+
+def scout_batch(writer, teams, player_names, heroes, state, league_indexes, draft_indexes,
+                workers=WORKERS, team_workers=TEAM_WORKERS, drafts=False, parse_queue=None, window=None,
+                columns=DEFAULT_COLUMNS):
+    # teams are scouted in parallel but written in manifest order, one sheet each
+    player_ids = set()
+    writer.write_overview_header()
+    with ThreadPoolExecutor(max_workers=team_workers) as executor:
+        league_ids = sorted({league_id for league_id, _ in teams})
+        league_indexes.update(zip(league_ids, executor.map(lambda l: LeagueIndex(l, state=state, window=window),
+                                                           league_ids)))
+        draft_indexes.update((league_id, DraftIndex(league_id, state=state,
+                                                    match_ids=league_indexes[league_id].get_window_match_ids()))
+                             for league_id in league_ids)
+        futures = [executor.submit(Team, team_id, player_names, heroes, league_indexes[league_id], workers=workers,
+                                   state=state, draft_index=draft_indexes[league_id], parse_queue=parse_queue)
+                   for league_id, team_id in teams]
+
+        for (league_id, team_id), future in zip(teams, futures):
+            try:
+                team = future.result()
+            except Exception as e:
+                print('Could not scout team {} in league {}: {}'.format(team_id, league_id, e))
+                continue
+
+            player_ids.update(team.players)
+            team.resolve_columns(columns)
+            with stats.phase('xlsx'):
+                writer.write_overview(team, league_id)
+                writer.add_worksheet(team.name)
+                writer.write_matches(team)
+                writer.write_summary(team)
+                if drafts:
+                    writer.write_drafts(team)
+                writer.write_legend()
+    return player_ids
+
+
+def get_pick_report(pick, heroes, columns):
+    report = {'hero_id': pick.hero_id, 'hero': heroes[pick.hero_id], 'order': pick.order, 'lane': pick.lane,
+              'roaming': pick.roaming}
+    if 'players' in columns:
+        report['player'] = pick.player_name
+    return report
+
+
+def get_count_report(team, counter):
+    return [{'hero_id': hero_id, 'hero': team.heroes[hero_id], 'count': count}
+            for hero_id, count in sorted(counter.items(), key=lambda c: (-c[1], team.heroes[c[0]]))]
+
+
+def get_team_report(team, columns=DEFAULT_COLUMNS):
+    # the same data as a team's sheet, for clients that would rather not parse xlsx
+    parsed_matches = []
+    for match in team.parsed_matches:
+        report = {'match_id': match.match_id, 'side': match.side, 'win': match.win, 'first_pick': match.first_pick}
+        if 'captain' in columns:
+            report['enemy_captain'] = match.enemy_captain
+        for field in ['picks', 'banned_against', 'bans']:
+            report[field] = [get_pick_report(p, team.heroes, columns)
+                             for p in sorted(getattr(match, field).values(), key=lambda p: p.order)]
+        parsed_matches.append(report)
+
+    unparsed_matches = []
+    for match in team.unparsed_matches:
+        report = {'match_id': match.match_id, 'side': match.side, 'win': match.win,
+                  'picks': [get_pick_report(p, team.heroes, columns)
+                            for p in sorted(match.picks.values(), key=lambda p: p.lane)]}
+        if team.parse_queue:
+            report['parse'] = team.parse_queue.get_status(match.match_id)
+        unparsed_matches.append(report)
+
+    picks = get_count_report(team, team.pick_count)
+    for pick in picks:
+        pick['wins'] = team.pick_wins[pick['hero_id']]
+
+    report = {'league_id': team.league_id, 'team_id': team.team_id, 'name': team.name, 'players': team.players,
+              'parsed_matches': parsed_matches, 'unparsed_matches': unparsed_matches,
+              'summary': {'picks': picks,
+                          'banned_against': get_count_report(team, team.banned_against_count),
+                          'bans': get_count_report(team, team.ban_count)}}
+    if team.draft_index:
+        report['first_pick_after_ban'] = [{'banned': team.heroes[banned], 'times': times,
+                                           'pick': team.heroes[hero_id], 'count': count}
+                                          for banned, times, hero_id, count
+                                          in team.draft_index.get_picks_after_bans(team.team_id)]
+    return report
+
+
+class ScoutServer(object):
+    def __init__(self, heroes, player_names, highlight_heroes, state=None, parse_queue=None, columns=DEFAULT_COLUMNS,
+                 workers=WORKERS, days=None, window=None, drafts=False, interval=SERVE_INTERVAL):
+        self.heroes = heroes
+        self.player_names = player_names
+        self.highlight_heroes = highlight_heroes
+        self.state = state
+        self.parse_queue = parse_queue
+        self.columns = columns
+        self.workers = workers
+        self.days = days
+        self.window = window
+        self.drafts = drafts
+        self.interval = interval
+        # teams are only read while the lock is held, the refresh thread does its downloads outside it
+        self.lock = threading.RLock()
+        self.stopped = threading.Event()
+        self.league_indexes = {}
+        self.draft_indexes = {}
+        self.teams = {}
+        self.players = {}
+        self.updated = None
+
+    def get_team(self, league_id, team_id):
+        with self.lock:
+            if (league_id, team_id) in self.teams:
+                return self.teams[(league_id, team_id)]
+            league_index = self.league_indexes.get(league_id)
+
+        # a team nobody asked for yet is scouted cold without holding up reports for the warm ones
+        if league_index is None:
+            league_index = LeagueIndex(league_id, state=self.state, window=self.window)
+            draft_index = DraftIndex(league_id, state=self.state, match_ids=league_index.get_window_match_ids())
+            with self.lock:
+                league_index = self.league_indexes.setdefault(league_id, league_index)
+                self.draft_indexes.setdefault(league_id, draft_index)
+        team = Team(team_id, self.player_names, self.heroes, league_index, workers=self.workers, state=self.state,
+                    draft_index=self.draft_indexes[league_id], parse_queue=self.parse_queue)
+        self.warm(team)
+        if 'profiles' in self.columns:
+            self.update_players(team.players)
+        with self.lock:
+            return self.teams.setdefault((league_id, team_id), team)
+
+    def warm(self, team):
+        # everything a report could need is looked up now, so serving one never waits on the network --
+        # the lookups don't change the team, the lock is only taken to fill in what they found
+        parses = team.fetch_parses()
+        with self.lock:
+            team.add_parses(parses)
+        names = team.fetch_names(self.columns)
+        with self.lock:
+            team.add_names(names)
+
+    def update_players(self, account_ids):
+        players = get_players(account_ids, self.player_names, self.heroes, workers=self.workers, days=self.days,
+                              window=self.window)
+        with self.lock:
+            self.players.update((player.account_id, player) for player in players)
+
+    def refresh(self):
+        # this thread is the only one changing teams that are already served, so it reads them without the lock
+        with self.lock:
+            teams = sorted(self.teams.items())
+            league_indexes = dict(self.league_indexes)
+
+        for league_id, league_index in sorted(league_indexes.items()):
+            league_index = league_indexes[league_id] = league_index.copy()
+            league_index.update(refresh=True)
+            with self.lock:
+                self.league_indexes[league_id] = league_index
+            if self.state:
+                league_index.save_state(self.state)
+
+        for (league_id, team_id), team in teams:
+            fetched = team.update(league_indexes[league_id])
+            with self.lock:
+                team.add_matches(fetched)
+            self.warm(team)
+            if self.state:
+                team.save_state(self.state, league_id)
+
+        if 'profiles' in self.columns:
+            self.update_players({account_id for _, team in teams for account_id in team.players})
+        self.updated = datetime.utcnow()
+
+    def run_refresh(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.refresh()
+            except Exception as e:
+                print('Could not refresh: {}'.format(e))
+
+    def get_status(self):
+        with self.lock:
+            return {'teams': [{'league_id': league_id, 'team_id': team_id, 'name': team.name,
+                               'matches': len(team.parsed_matches) + len(team.unparsed_matches)}
+                              for (league_id, team_id), team in sorted(self.teams.items())],
+                    'updated': self.updated.isoformat() if self.updated else None,
+                    'stats': stats.to_dict()}
+
+    def get_json(self, team):
+        with self.lock:
+            return get_team_report(team, self.columns)
+
+    def get_xlsx(self, team):
+        output = BytesIO()
+        with self.lock:
+            writer = XlsxWriter(output, sheet_name=team.name, columns=self.columns)
+            writer.write_matches(team)
+            writer.write_summary(team)
+            if self.drafts:
+                writer.write_drafts(team)
+            writer.write_legend()
+            if 'profiles' in self.columns:
+                writer.add_worksheet('PLAYERS')
+                writer.write_players([self.players[a] for a in team.players if a in self.players],
+                                     self.highlight_heroes)
+            writer.close()
+        return output.getvalue()
+
+    def serve(self, host=SERVE_HOST, port=SERVE_PORT):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        handler = type('ScoutHTTPRequestHandler', (ScoutRequestHandler, BaseHTTPRequestHandler), {})
+        httpd = ThreadingHTTPServer((host, port), handler)
+        httpd.scout = self
+        threading.Thread(target=self.run_refresh, daemon=True).start()
+        print('Serving reports on http://{}:{}/leagues/LEAGUE_ID/teams/TEAM_ID.xlsx (or .json)'.format(host, port))
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stopped.set()
+            httpd.server_close()
+
+
+class ScoutRequestHandler(object):
+    # mixed into http.server's BaseHTTPRequestHandler by ScoutServer.serve, which is the only place it is imported
+    def do_GET(self):
+        scout = self.server.scout
+        parts = urlsplit(self.path).path.strip('/').split('/')
+        if parts == ['status']:
+            return self.send_json(200, scout.get_status())
+        if len(parts) != 4 or parts[0] != 'leagues' or parts[2] != 'teams':
+            return self.send_json(404, {'error': 'expected /leagues/LEAGUE_ID/teams/TEAM_ID.json or .xlsx'})
+
+        team_id, _, extension = parts[3].partition('.')
+        if extension not in ('json', 'xlsx'):
+            return self.send_json(404, {'error': 'reports are available as .json or .xlsx'})
+
+        try:
+            team = scout.get_team(parts[1], team_id)
+            if extension == 'json':
+                return self.send_json(200, scout.get_json(team))
+            body = scout.get_xlsx(team)
+        except Exception as e:
+            return self.send_json(500, {'error': str(e)})
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+        self.send_header('Content-Disposition', 'attachment; filename="{}.xlsx"'.format(team_id))
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def get_columns(value):
+    columns = [column.strip().lower() for column in value.split(',') if column.strip()]
+    for column in columns:
+        if column not in COLUMNS:
+            raise Exception('{} is not a valid column -- choose from {}'.format(column, ', '.join(COLUMNS)))
+    return columns
+
+
+def get_timestamp(value, end=False):
+    # a bare date means the whole day, so --until 2024-05-01 still includes matches played on the 1st
+    date = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    if end and len(value) == len('YYYY-MM-DD'):
+        date += timedelta(days=1)
+    return date.timestamp()
+
+
+def get_window(since=None, until=None, patch=None):
+    if not since and not until and not patch:
+        return None
+
+    window = Window(get_timestamp(since) if since else None, get_timestamp(until, end=True) if until else None)
+    if patch:
+        patches = sorted(opendota_api_call('constants', 'patch'), key=lambda p: p['date'])
+        names = [p['name'] for p in patches]
+        if patch not in names:
+            raise Exception('{} is not a valid patch -- choose from {}'.format(patch, ', '.join(names[-5:])))
+
+        # a patch lasts until the next one comes out, --since and --until can narrow it further
+        index = names.index(patch)
+        window.patch_id = patches[index]['id']
+        start = get_timestamp(patches[index]['date'])
+        window.since = max(window.since or start, start)
+        if index + 1 < len(patches):
+            end = get_timestamp(patches[index + 1]['date'])
+            window.until = min(window.until or end, end)
+    return window
+
+
 def get_args():
     parser = ArgumentParser()
     parser.add_argument('api_key', help='steam api key -- you can get a key from https://steamcommunity.com/dev/apikey')
@@ -474,44 +2380,173 @@ def get_args():
     parser.add_argument('-t', '--team-id', action='append', default=[], help='(optional -- supports multiples) teams to scout -- you can get this from dotabuff')
     parser.add_argument('-p', '--player', action='append', default=[], help='(optional -- supports multiples) players to scout -- you can get this from dotabuff')
     parser.add_argument('-c', '--counterpick-heroes', help='(optional) file of heroes to highlight if found in recent matches; file should be comma separated')
-    parser.add_argument('-f', '--file', help='the file to save results to')
+    parser.add_argument('-f', '--file', help='the file to save results to -- a directory for the csv, jsonl and parquet formats')
+    parser.add_argument('--format', choices=FORMATS, default='xlsx', help='(optional) xlsx for the formatted report, or csv, jsonl or parquet for one raw table per file -- parquet needs pyarrow')
+    parser.add_argument('-m', '--manifest', help='(optional) json file of teams and players to scout in one batch, e.g. {"teams": [{"league_id": 1, "team_id": 2}], "players": [3]} -- each team gets its own sheet')
+    parser.add_argument('--team-workers', type=int, default=TEAM_WORKERS, help='(optional) how many teams to scout at the same time in batch mode -- defaults to {}'.format(TEAM_WORKERS))
+    parser.add_argument('-w', '--workers', type=int, default=WORKERS, help='(optional) how many requests to make at the same time -- defaults to {}'.format(WORKERS))
+    parser.add_argument('--steam-rate', type=float, default=RATE_LIMITS['api.steampowered.com'], help='(optional) steam api requests per second')
+    parser.add_argument('--opendota-rate', type=float, default=RATE_LIMITS['api.opendota.com'], help='(optional) opendota api requests per second -- raise this if you have an opendota api key')
+    parser.add_argument('-i', '--incremental', action='store_true', help='(optional) only fetch league matches newer than the last incremental run and merge them into the saved results')
+    parser.add_argument('--state-file', default=STATE_FILE, help='(optional) where incremental runs keep their results -- defaults to {}'.format(STATE_FILE))
+    parser.add_argument('--since', help='(optional) only scout matches played on or after this date, e.g. 2024-05-01')
+    parser.add_argument('--until', help='(optional) only scout matches played on or before this date')
+    parser.add_argument('--patch', help='(optional) only scout matches played on this patch, e.g. 7.35d -- also limits player hero stats to it')
+    parser.add_argument('--player-days', type=int, help='(optional) only count player hero stats from the last this many days -- defaults to all time')
+    parser.add_argument('--constant-memory', action='store_true', help='(optional) stream rows to disk as they are written instead of building the whole workbook in memory')
+    parser.add_argument('--record', metavar='DIR', help='(optional) save every api response to this fixture directory -- implies --refresh-cache so cached responses are recorded too')
+    parser.add_argument('--replay', metavar='DIR', help='(optional) serve api responses from a fixture directory instead of the network')
+    parser.add_argument('--replay-latency', type=float, default=0, help='(optional) seconds of synthetic latency to add to each replayed response')
+    parser.add_argument('-a', '--analytics', action='store_true', help='(optional) add league-wide hero meta, synergy and counter sheets for every scouted league -- needs numpy')
+    parser.add_argument('-d', '--drafts', action='store_true', help="(optional) add a table of each team's first pick after every hero banned before it")
+    parser.add_argument('--columns', default=','.join(DEFAULT_COLUMNS), help='(optional) comma separated optional columns that cost extra requests: {} -- defaults to {}'.format(', '.join(COLUMNS), ','.join(DEFAULT_COLUMNS)))
+    parser.add_argument('--fast', action='store_true', help='(optional) skip every optional column for a quick pick/ban overview that costs one request per match')
+    parser.add_argument('--no-parse-requests', action='store_true', help="(optional) don't ask opendota to parse league matches it hasn't parsed yet")
+    parser.add_argument('--parse-wait', type=float, default=0, help='(optional) seconds to wait for requested parses before writing matches that are still unparsed -- pending requests are picked up again on the next run')
+    parser.add_argument('--serve', action='store_true', help='(optional) keep running and serve team reports over http instead of writing a file -- the teams given with -t or --manifest are scouted up front, any other team on first request')
+    parser.add_argument('--host', default=SERVE_HOST, help='(optional) address to serve on -- defaults to {}'.format(SERVE_HOST))
+    parser.add_argument('--port', type=int, default=SERVE_PORT, help='(optional) port to serve on -- defaults to {}'.format(SERVE_PORT))
+    parser.add_argument('--refresh-interval', type=float, default=SERVE_INTERVAL, help='(optional) seconds between checks for new league matches while serving -- defaults to {}'.format(SERVE_INTERVAL))
+    parser.add_argument('--stats', action='store_true', help='(optional) print per-phase timings, per-endpoint request counts and cache hits when done')
+    parser.add_argument('--stats-json', metavar='FILE', help='(optional) write the same stats to a json file')
+    parser.add_argument('--profile', metavar='FILE', help='(optional) run under cProfile and dump the results to this file')
+    parser.add_argument('--cache-file', default=CACHE_FILE, help='(optional) where to keep cached api responses -- defaults to {}'.format(CACHE_FILE))
+    parser.add_argument('--heroes-file', default=HEROES_FILE, help='(optional) where to keep the hero table between runs -- defaults to {}'.format(HEROES_FILE))
+    parser.add_argument('--cache-ttl', type=float, default=CACHE_TTL / 3600, help='(optional) hours before cached player, hero and match history responses expire -- match details never expire')
+    parser.add_argument('--name-ttl', type=float, default=NAME_TTL / 3600, help='(optional) hours before cached player names expire')
+    parser.add_argument('--no-cache', action='store_true', help='(optional) bypass the response cache entirely')
+    parser.add_argument('--refresh-cache', action='store_true', help='(optional) ignore cached responses but store the fresh ones')
+    parser.add_argument('--prune-cache', action='store_true', help='(optional) delete expired responses from the cache before running')
     return parser.parse_args()
 
 
-if __name__ == '__main__':
-    args = get_args()
+def main(args):
+    global DOTA_BASE_URL, STEAM_USER_BASE_URL, client, cache, name_ttl, hero_index
+
     current_time = datetime.utcnow().strftime('%Y%m%d%H%M%S')
-    file = args.file if args.file else '{}.xlsx'.format(current_time)
+    # the table formats write a directory of files, one per table
+    file = args.file if args.file else current_time + ('.xlsx' if args.format == 'xlsx' else '')
     DOTA_BASE_URL = DOTA_BASE_URL.format(api_key=args.api_key)
+    STEAM_USER_BASE_URL = STEAM_USER_BASE_URL.format(api_key=args.api_key)
+    name_ttl = args.name_ttl * 3600
+    client = HttpClient(rate_limits={'api.steampowered.com': args.steam_rate, 'api.opendota.com': args.opendota_rate},
+                        pool_size=args.workers, record_dir=args.record, replay_dir=args.replay,
+                        replay_latency=args.replay_latency)
+    # a recording has to hit the network for every response, so cached ones are fetched again
+    refresh = args.refresh_cache or bool(args.record)
+    if not args.no_cache:
+        cache = ResponseCache(args.cache_file, ttl=args.cache_ttl * 3600, refresh=refresh)
+        if args.prune_cache:
+            print('Pruned {} expired responses from the cache'.format(cache.prune()))
+    # pending parse requests are kept in the state file even when the run isn't incremental
+    parse = not args.fast and not args.no_parse_requests
+    store = StateStore(args.state_file) if args.incremental or parse else None
+    state = store if args.incremental else None
+    parse_queue = ParseQueue(state=store, wait=args.parse_wait) if parse else None
     player_names = {}
-    players = {}
     player_ids = set(args.player)
-    heroes = get_heroes()
-    highlight_heroes = []
+    with stats.phase('heroes'):
+        hero_index = HeroIndex(None if args.no_cache else args.heroes_file, refresh=refresh)
+    heroes = hero_index.heroes
+    highlight_heroes = set()
 
     if args.counterpick_heroes:
         with open(args.counterpick_heroes) as f:
-            lowered_hero_names = [h.lower() for h in heroes.values()]
             for hero in f.read().split(','):
-                filtered_hero = hero.strip().lower()
-                if filtered_hero not in lowered_hero_names:
+                hero_id, guessed = hero_index.find(hero)
+                if hero_id is None:
                     print('Warning: {} not a valid hero name and will be ignored'.format(hero))
                     continue
-                highlight_heroes.append(filtered_hero)
+                if guessed:
+                    print('Warning: {} not a valid hero name, using {}'.format(hero.strip(), heroes[hero_id]))
+                highlight_heroes.add(heroes[hero_id].lower())
 
+    league_indexes = {}
+    draft_indexes = {}
+    columns = [] if args.fast else get_columns(args.columns)
     try:
-        writer = XlsxWriter(file)
-        for team_id in args.team_id:
-            team = Team(team_id, player_names, heroes, league_id=args.league_id)
-            player_ids.update(team.players)
-            writer.write_matches(team)
-            writer.write_summary(team)
-        writer.write_legend()
+        window = get_window(args.since, args.until, args.patch)
+        if args.serve:
+            server = ScoutServer(heroes, player_names, highlight_heroes, state=state, parse_queue=parse_queue,
+                                 columns=columns, workers=args.workers, days=args.player_days, window=window,
+                                 drafts=args.drafts, interval=args.refresh_interval)
+            teams = read_manifest(args.manifest)[0] if args.manifest else []
+            teams += [(args.league_id, team_id) for team_id in args.team_id if args.league_id]
+            for league_id, team_id in teams:
+                server.get_team(league_id, team_id)
+            server.serve(args.host, args.port)
+        else:
+            if args.manifest:
+                teams, manifest_players = read_manifest(args.manifest)
+                teams += [(args.league_id, team_id) for team_id in args.team_id if args.league_id]
+                player_ids.update(manifest_players)
+                writer = get_writer(args.format, file, columns, constant_memory=args.constant_memory,
+                                    sheet_name='OVERVIEW')
+                roster_ids = scout_batch(writer, teams, player_names, heroes, state, league_indexes, draft_indexes,
+                                         workers=args.workers, team_workers=args.team_workers, drafts=args.drafts,
+                                         parse_queue=parse_queue, window=window, columns=columns)
+                if 'profiles' in columns:
+                    player_ids.update(roster_ids)
+                writer.add_worksheet('PLAYERS')
+            else:
+                writer = get_writer(args.format, file, columns, constant_memory=args.constant_memory)
+                league_index = None
+                if args.league_id and (args.team_id or args.analytics):
+                    league_index = league_indexes[args.league_id] = LeagueIndex(args.league_id, state=state,
+                                                                                window=window)
+                    draft_indexes[args.league_id] = DraftIndex(args.league_id, state=state,
+                                                               match_ids=league_index.get_window_match_ids())
+                for team_id in args.team_id:
+                    team = Team(team_id, player_names, heroes, league_index, workers=args.workers, state=state,
+                                draft_index=draft_indexes.get(args.league_id), parse_queue=parse_queue)
+                    if 'profiles' in columns:
+                        player_ids.update(team.players)
+                    team.resolve_columns(columns)
+                    with stats.phase('xlsx'):
+                        writer.write_matches(team)
+                        writer.write_summary(team)
+                        if args.drafts:
+                            writer.write_drafts(team)
+                with stats.phase('xlsx'):
+                    writer.write_legend()
+
+            players = get_players(player_ids, player_names, heroes, workers=args.workers, days=args.player_days,
+                                  window=window)
+            with stats.phase('xlsx'):
+                writer.write_players(players, highlight_heroes)
+
+            if args.analytics:
+                for league_id in sorted(league_indexes):
+                    analytics = LeagueAnalytics(league_indexes[league_id], heroes, workers=args.workers)
+                    with stats.phase('xlsx'):
+                        writer.write_analytics(analytics)
+
+            with stats.phase('xlsx'):
+                writer.close()
+    except Exception as e:
+        print(e)
+    finally:
+        if parse_queue:
+            parse_queue.close()
+        hero_index.close()
+        client.close()
+        if cache:
+            cache.close()
+        if store:
+            store.close()
+
+    if args.stats:
+        stats.print()
+    if args.stats_json:
+        with open(args.stats_json, 'w') as f:
+            json.dump(stats.to_dict(), f, indent=2)
 
-        for player in player_ids:
-            players[player] = Player(player, player_names, heroes)
 
-        writer.write_players(players.values(), highlight_heroes)
-        writer.close()
-    except Exception as e:
-        print(e)
\ No newline at end of file
+if __name__ == '__main__':
+    args = get_args()
+    if args.profile:
+        profiler = cProfile.Profile()
+        profiler.runcall(main, args)
+        profiler.dump_stats(args.profile)
+    else:
+        main(args)